@@ -4,6 +4,20 @@ from numpy.lib.arraysetops import isin
 import pandas as pd
 import random
 import math
+import os
+import glob
+import json
+import hashlib
+import tempfile
+import scipy.sparse
+import scipy.special
+import itertools
+import functools
+import sqlite3
+import time
+import multiprocessing
+import signal
+import warnings
 import pyphi # needs nonbinary install
 pyphi.config.PARTITION_TYPE = 'ALL'
 # pyphi.config.MEASURE = 'AID'
@@ -19,16 +33,234 @@ class Neuron:
         Binarises a spike-train with bins of size S. 
         - a is a list of times when the neuron fired. 
         """
-        a_states = np.zeros(math.ceil(max(a)/S))
-        for spike_t in a:
-            index = int(spike_t / S)
-            a_states[index] = 1
+        a = np.asarray(a)
+        a_states = np.zeros(math.ceil(a.max()/S))
+        a_states[(a / S).astype(np.int64)] = 1
         return a_states
 
+    @staticmethod
+    def binarise_spiketrains(spiketrains, binsizes):
+        """
+        Binarises a set of spike-trains at every bin size in binsizes in one batched pass.
+        - spiketrains is a list of arrays of times when each neuron fired.
+        - binsizes is a list of bin sizes S.
+
+        Returns a list with one array per bin size, each of shape (num neurons, T), 
+        where T is the length of the shortest binarised train at that bin size. 
+        This is the same output as calling TPMMaker.get_binarised_trains once per bin size, 
+        but the bin index of every spike is computed for all bin sizes at once
+        and the rasters are filled with scatter writes, with no per-spike Python work. 
+        """
+        trains = [np.asarray(a, dtype=np.float64) for a in spiketrains]
+        binsizes = np.asarray(binsizes, dtype=np.float64).reshape(-1)
+
+        times = np.concatenate(trains)
+        neuron_ids = np.repeat(np.arange(len(trains)), [len(a) for a in trains])
+        # bin index of every spike at every bin size, shape (num binsizes, num spikes)
+        indices = (times[np.newaxis, :] / binsizes[:, np.newaxis]).astype(np.int64)
+
+        # don't consider further than the shortest train, as in get_binarised_trains
+        maxima = np.array([a.max() for a in trains])
+        lengths = np.ceil(maxima[np.newaxis, :] / binsizes[:, np.newaxis]).astype(np.int64).min(axis=1)
+
+        rasters = []
+        for b in range(len(binsizes)):
+            keep = indices[b] < lengths[b]
+            raster = np.zeros((len(trains), lengths[b]))
+            raster[neuron_ids[keep], indices[b, keep]] = 1
+            rasters.append(raster)
+        return rasters
+
+    @staticmethod
+    def count_spiketrain(a, S, max_count):
+        """
+        Counts the spikes of a spike-train in bins of size S, clipping the counts at max_count.
+        Each bin is then in one of max_count+1 states: 0 spikes, 1 spike, ..., max_count or more spikes.
+        - a is a list of times when the neuron fired. 
+        """
+        a = np.asarray(a)
+        length = math.ceil(a.max()/S)
+        a_counts = np.bincount((a / S).astype(np.int64), minlength=length)[:length]
+        return np.minimum(a_counts, max_count).astype(np.float64)
+
+class Raster:
+    """
+    Bit-packed binarised spike-trains of a set of neurons, storing 8 bins per byte
+    instead of the 8 bytes per bin of the float arrays returned by TPMMaker.get_binarised_trains.
+        - packed is a uint8 array of shape (num neurons, num bytes), packed along time as by np.packbits.
+        - lengths holds the number of bins in each neuron's binarised train.
+
+    As in TPMMaker.get_binarised_trains, the raster is not considered further than 
+    the shortest train of the neurons it holds, so that taking a subset of neurons 
+    gives exactly the binarised trains of that subset.
+    """
+    def __init__(self, packed, lengths):
+        self.packed = packed
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.n_bins = int(self.lengths.min())
+
+    @property
+    def shape(self):
+        return (self.packed.shape[0], self.n_bins)
+
+    @staticmethod
+    def from_dense(binaryneurons):
+        binaryneurons = np.asarray(binaryneurons)
+        packed = np.packbits(binaryneurons.astype(bool), axis=1)
+        return Raster(packed, [binaryneurons.shape[1]] * binaryneurons.shape[0])
+
+    @staticmethod
+    def from_spiketrains(spiketrains, S):
+        """
+        Binarises every spike-train with bins of size S straight into packed form, 
+        without ever holding the dense raster of all neurons in memory.
+        """
+        lengths = [math.ceil(np.max(a)/S) for a in spiketrains]
+        num_bytes = math.ceil(max(lengths) / 8)
+        packed = np.zeros((len(spiketrains), num_bytes), dtype=np.uint8)
+        for n in range(len(spiketrains)):
+            indices = np.unique((np.asarray(spiketrains[n]) / S).astype(np.int64))
+            indices = indices[indices < lengths[n]]
+            # bins are distinct, so summing their bit values within a byte is the same as OR-ing them
+            bits = np.left_shift(1, 7 - (indices & 7))
+            packed[n] = np.bincount(indices >> 3, weights=bits, minlength=num_bytes)
+        return Raster(packed, lengths)
+
+    def neurons(self, indices):
+        """The raster of a subset of neurons. A slice gives a view of the packed data."""
+        if isinstance(indices, slice):
+            return Raster(self.packed[indices], self.lengths[indices])
+        indices = np.asarray(indices)
+        return Raster(self.packed[indices], self.lengths[indices])
+
+    def window(self, start, stop):
+        """
+        The dense binarised trains, as a uint8 array, for bins start to stop. 
+        Only the bytes covering the window are unpacked.
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_bins)
+        stop = max(start, stop)
+        first_byte, last_byte = start // 8, math.ceil(stop / 8)
+        bits = np.unpackbits(self.packed[:, first_byte:last_byte], axis=1)
+        return bits[:, start - 8*first_byte : stop - 8*first_byte]
+
+    def to_dense(self):
+        return self.window(0, self.n_bins)
+
+    @staticmethod
+    def as_array(binaryneurons):
+        """Lets functions taking binarised trains accept either a dense array or a Raster"""
+        if isinstance(binaryneurons, Raster):
+            return binaryneurons.to_dense()
+        return binaryneurons
+
+class RasterCache:
+    """
+    On-disk cache of the Raster of every neuron of a recording, one file per (session, probe, binsize).
+    Each raster is written once, as a .npy of the packed bits plus a .json with the lengths of the trains, 
+    and later runs (or concurrent worker processes) memory-map it instead of re-parsing and re-binning 
+    the cell{i}.txt spike files. Row i of a cached raster is the train of cell{i}.txt.
+
+    A cached raster is rebuilt whenever the size or modification time of any spike file changes.
+    Files are written to a temporary name and moved into place, so a worker never maps a partly written file.
+    Building is guarded by a lock file per (session, probe): one process parses the spike files, 
+    once for all the binsizes asked for, while the others wait for it and then map its rasters.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def get_cell_files(infolder):
+        num_cells = len(glob.glob(os.path.join(infolder, "cell*.txt")))
+        return [os.path.join(infolder, "cell" + str(i) + ".txt") for i in range(num_cells)]
+
+    @staticmethod
+    def get_source_signature(cell_files):
+        """Hash of the name, size and modification time of each spike file"""
+        h = hashlib.sha1()
+        for f in cell_files:
+            st = os.stat(f)
+            h.update((os.path.basename(f) + ":" + str(st.st_size) + ":" + str(st.st_mtime_ns) + ";").encode())
+        return h.hexdigest()
+
+    def get_path(self, S, session, probe):
+        """The path of the raster with bins of size S, without extension; S=None for the files of the whole (session, probe)"""
+        name = "_".join(str(x) for x in [session, probe] if x is not None)
+        if S is not None:
+            name += "_bin_" + repr(float(S))
+        return os.path.join(self.folder, name)
+
+    def get(self, infolder, S, session=None, probe=None, units=1000):
+        """
+        Get the Raster, with bins of size S, of every cell{i}.txt in infolder. 
+            - session defaults to the name of infolder. 
+            - units is what the loaded spike times are divided by to get seconds
+            (the cell files are in milliseconds).
+        """
+        return self.get_many(infolder, [S], session, probe, units)[0]
+
+    def get_many(self, infolder, binsizes, session=None, probe=None, units=1000):
+        """
+        Get the Raster of every cell{i}.txt in infolder for each binsize (see get), 
+        loading the spike files at most once for all the binsizes that are not cached yet.
+        """
+        if session is None:
+            session = os.path.basename(os.path.normpath(infolder))
+        cell_files = RasterCache.get_cell_files(infolder)
+        signature = RasterCache.get_source_signature(cell_files)
+        paths = [self.get_path(S, session, probe) for S in binsizes]
+        rasters = [self._load(path, signature) for path in paths]
+        if all(raster is not None for raster in rasters):
+            return rasters
+
+        import fcntl   # Unix only, so only imported when something needs building
+        lock_path = self.get_path(None, session, probe) + ".lock"
+        with open(lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)   # released when the file is closed, or the process dies
+            # another process may have built them while this one waited for the lock
+            rasters = [self._load(path, signature) for path in paths]
+            missing = [i for i in range(len(paths)) if rasters[i] is None]
+            if missing:
+                spiketrains = [np.loadtxt(f) / units for f in cell_files]
+                for i in missing:
+                    raster = Raster.from_spiketrains(spiketrains, binsizes[i])
+                    # the .npy goes in first, so a .json with a matching signature always refers to a complete .npy
+                    self._write_atomic(paths[i] + ".npy", lambda f: np.save(f, raster.packed))
+                    meta = {"signature": signature, "lengths": raster.lengths.tolist(), "binsize": float(binsizes[i])}
+                    self._write_atomic(paths[i] + ".json", lambda f: f.write(json.dumps(meta).encode()))
+                    rasters[i] = self._load(paths[i], signature)
+        return rasters
+
+    def _load(self, path, signature):
+        # the cached raster at path, or None if it is not cached yet, is stale or broken (to be rebuilt)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            if meta["signature"] == signature:
+                return Raster(np.load(path + ".npy", mmap_mode='r'), meta["lengths"])
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _write_atomic(self, path, write):
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
 class TPMMaker:
 
+    # Above this many bytes for the dense TPM and num_transitions arrays together, 
+    # the TPM builders switch to scipy.sparse CSR matrices (unless told otherwise with sparse=True/False).
+    DENSE_MEMORY_BUDGET = 2**28
+
     @staticmethod    
-    def get_TPM_index(state):  # rename this
+    def get_TPM_index(state, base=2):  # rename this
         """
         Given the state of a set of neurons, get the
         index into the TPM that the state corresponds to.
@@ -49,40 +281,109 @@ class TPMMaker:
                 in order from first to last in the state input. 
                 - Note that for the binary arrays accepted by this function, 
                 n = 2^(m), where m is the size of the binary array that describes the state of a node. 
+                - For spike counts clipped at c (see Neuron.count_spiketrain), each bin is a digit
+                in base c+1 rather than a bit, so n = (c+1)^(m). 
         """
-        n = 2**(state.shape[1])
-        index = 0
-        for i in range(state.shape[0]):
-            dec_node = int("".join(str(int(j)) for j in state[i,:]), 2)
-            index += dec_node * n ** i
-        return index
+        return int(TPMMaker.encode_states(state, state.shape[1], base)[0])
+
     @staticmethod
-    def get_num_state_occurrences(spiketrains, S, K, skipby):
+    def encode_states(binaryneurons, K, base=2):
+        """
+        Gets the TPM index (see get_TPM_index) of the state in every window of K bins 
+        of a set of binarised trains, in one vectorized pass. 
+            - Returns a uint64 array codes of length T-K+1, where T is the number of bins, 
+            and codes[t] is the index of the state binaryneurons[:, t:t+K], the window ending at bin t+K-1.
+            - The first bin in a window is the most significant digit of the node's state, 
+            and the first neuron varies fastest, following PyPhi's little-endian convention.
+            - For binarised trains (base 2), digits and nodes are combined with bit shifts.
+        """
+        binaryneurons = Raster.as_array(binaryneurons)
+        num_neurons, num_bins = binaryneurons.shape
+        assert (base**K)**num_neurons <= 2**64, "Too many states to index with uint64"
+        num_windows = max(num_bins - K + 1, 0)
+        digits = binaryneurons.astype(np.uint64)
+
+        codes = np.zeros(num_windows, dtype=np.uint64)
+        for n in range(num_neurons):   # loops over neurons and bins in a window only, never over time
+            node = np.zeros(num_windows, dtype=np.uint64)
+            for k in range(K):
+                if base == 2:
+                    node = (node << np.uint64(1)) | digits[n, k:k + num_windows]
+                else:
+                    node = node * np.uint64(base) + digits[n, k:k + num_windows]
+            if base == 2:
+                codes |= node << np.uint64(K * n)
+            else:
+                codes += node * np.uint64((base**K)**n)
+        return codes
+    @staticmethod
+    def get_num_state_occurrences(spiketrains, S, K, skipby, max_count=None):
         """Gets the number of occurrences of each state in the TPM, if we sample
         all occurrences of each state when creating the TPM (which we don't)
+            - If max_count is given, states are built from spike counts clipped at max_count
+            rather than from binarised trains (see TPMMaker.get_count_trains).
         """
-        binaryneurons = TPMMaker.get_binarised_trains(spiketrains, S)
+        if max_count is None:
+            binaryneurons = TPMMaker.get_binarised_trains(spiketrains, S)
+            base = 2
+        else:
+            binaryneurons = TPMMaker.get_count_trains(spiketrains, S, max_count)
+            base = max_count + 1
         assert K >= 1
         assert binaryneurons.shape[0] >= 1
 
-        size = (2**K)**binaryneurons.shape[0]
+        size = (base**K)**binaryneurons.shape[0]
         
-        # initialise num_transition 
-        num_transitions = np.zeros(size)
-
-        # get a randomly ordered list of indices at which to look at transitions
-        # start at K-1 because our state at time i looks BACK to i-1, i-2,.. to build the rest of state
-        rand_indices = np.array(list(range(K-1, binaryneurons.shape[1] - skipby)))
-        np.random.shuffle(rand_indices)
-
-        for i in rand_indices:
-            curr_state = binaryneurons[:,i-(K-1):(i+1)]
-            i_c = TPMMaker.get_TPM_index(curr_state)
-            num_transitions[i_c] += 1
+        # count the states at every index that has a future state, 
+        # starting at K-1 because our state at time i looks BACK to i-1, i-2,.. to build the rest of state
+        codes = TPMMaker.encode_states(binaryneurons, K, base)
+        num_observed = max(binaryneurons.shape[1] - skipby - (K-1), 0)
+        num_transitions = np.bincount(codes[:num_observed].astype(np.int64), minlength=size).astype(np.float64)
         
         return num_transitions
     @staticmethod
-    def get_TPM_nonbinary(binaryneurons, K, skipby, required_obs):
+    def get_min_state_occurrences(binaryneurons, K, skips, base=2):
+        """
+        For each skip in skips, the fewest times any state occurs among the observations 
+        get_TPM_nonbinary samples from, i.e. the min of get_num_state_occurrences.
+        The states are encoded and counted once; a longer skip just drops the last observations.
+        """
+        binaryneurons = Raster.as_array(binaryneurons)
+        size = (base**K)**binaryneurons.shape[0]
+        codes = TPMMaker.encode_states(binaryneurons, K, base).astype(np.int64)
+
+        min_occurrences = np.zeros(len(skips))
+        order = np.argsort(skips)
+        # the observations for skip s are codes[:T-s-(K-1)]
+        ends = [max(binaryneurons.shape[1] - skips[j] - (K-1), 0) for j in order]
+        counts = np.bincount(codes[:ends[0]], minlength=size)
+        for n in range(len(order)):
+            if n > 0:
+                counts -= np.bincount(codes[ends[n]:ends[n-1]], minlength=size)
+            min_occurrences[order[n]] = counts.min()
+        return min_occurrences
+
+    @staticmethod
+    def get_feasibility(binarised, Ks, skips, required_obs, base=2):
+        """
+        Which (binsize, K, skip) configurations can give a TPM, i.e. 
+        every state is observed at least required_obs times, so get_TPM_nonbinary won't raise.
+        This only counts encoded states, so it is far cheaper than building the TPMs. 
+            - binarised is a list of binarised trains, one per binsize, as returned by Neuron.binarise_spiketrains
+            (or a list of Rasters).
+
+        Returns a boolean array of shape (len(binarised), len(Ks), len(skips))
+        """
+        feasible = np.zeros((len(binarised), len(Ks), len(skips)), dtype=bool)
+        for i in range(len(binarised)):
+            binaryneurons = Raster.as_array(binarised[i])
+            for k in range(len(Ks)):
+                min_occurrences = TPMMaker.get_min_state_occurrences(binaryneurons, Ks[k], skips, base)
+                feasible[i,k] = min_occurrences >= required_obs
+        return feasible
+
+    @staticmethod
+    def get_TPM_nonbinary(binaryneurons, K, skipby, required_obs, base=2, sparse=None):
         """Given an array of binarised neuron spike-trains
         and a K value for how many time-steps to include in a single state, 
         get the TPM of the system. 
@@ -91,6 +392,11 @@ class TPMMaker:
         Example: 
             if K = 3, then find the TPM that describes 
             the transition probability of System[t-2,t-1,t] --> System[t+1,t+2,t+3]
+            - binaryneurons may also be a Raster, e.g. a subset of a whole probe's raster.
+            - base is the number of states of a single bin: 2 for binarised trains, 
+            max_count+1 for spike counts clipped at max_count.
+            - sparse chooses scipy.sparse CSR matrices for the returned arrays. By default they are 
+            sparse only if the dense arrays would exceed TPMMaker.DENSE_MEMORY_BUDGET.
 
         Returns:
             - A TPM of the system in state-state mode (TODO: conventions?)
@@ -98,39 +404,23 @@ class TPMMaker:
             number of transitions that were used to calculate the value of TPM[i,j].
         
         """
+        binaryneurons = Raster.as_array(binaryneurons)
         assert K >= 1
         assert binaryneurons.shape[0] >= 1
 
-        size = (2**K)**binaryneurons.shape[0]
+        size = (base**K)**binaryneurons.shape[0]
         
-        # initialise TPM and num_transitions arrays
-        TPM = np.zeros((size, size))
-        num_transitions = np.zeros((size, size))
-
         # get a randomly ordered list of indices at which to look at transitions
         # start at K-1 because our state at time i looks BACK to i-1, i-2,.. to build the rest of state
-        rand_indices = np.array(list(range(K-1, binaryneurons.shape[1] - skipby)))
+        rand_indices = np.arange(K-1, binaryneurons.shape[1] - skipby)
         np.random.shuffle(rand_indices)
-        for i in rand_indices:
-            curr_state = binaryneurons[:,i-(K-1):(i+1)]
-            i_c = TPMMaker.get_TPM_index(curr_state)
-            total = sum(num_transitions[i_c,:])
-            if total >= required_obs:   # don't add this observation if we already have enough
-                continue
-
-            future_state = binaryneurons[:,i-(K-1) + skipby:(i+1) + skipby]   # Ugly indexing 
-            i_f = TPMMaker.get_TPM_index(future_state)
-
-            num_transitions[i_c, i_f] += 1
-        
-        for j in range(num_transitions.shape[0]):
-            total = sum(num_transitions[j,:])
-            if total < required_obs:
-                raise ValueError("State with index " + str(j) + \
-                " was observed in the data fewer than " + str(required_obs) + " times, (" + str(total) + " times only).")
-            
-            TPM[j,:] = num_transitions[j,:] / total
+        # the state of the window ending at i is codes[i-(K-1)]
+        codes = TPMMaker.encode_states(binaryneurons, K, base).astype(np.int64)
+        curr = codes[rand_indices - (K-1)]
+        future = codes[rand_indices - (K-1) + skipby]
+        num_transitions = TPMMaker.get_capped_transitions(curr, future, size, required_obs, TPMMaker.use_sparse(size, sparse))
         
+        TPM = TPMMaker.normalise_transitions(num_transitions, required_obs)
         return TPM, num_transitions
         
 
@@ -144,6 +434,7 @@ class TPMMaker:
         Example: 
             if K = 3, then find the TPM that describes 
             the transition probability of System[t-2,t-1,t] --> System[t+1,t+2,t+3]
+            - binaryneurons may also be a Raster, e.g. a subset of a whole probe's raster.
 
         Returns:
             - A TPM of the system in state-state mode (TODO: conventions?)
@@ -152,61 +443,447 @@ class TPMMaker:
         
         - always samples in order, starting from startindex
         """
+        binaryneurons = Raster.as_array(binaryneurons)
         assert K >= 1
         assert binaryneurons.shape[0] >= 1
 
         size = (2**K)**binaryneurons.shape[0]
         
-        # initialise TPM and num_transitions arrays
-        TPM = np.zeros((size, size))
-        num_transitions = np.zeros((size, size))
-
         # get an ordered list of indices at which to look at transitions
         # start at K-1 because our state at time i looks BACK to i-1, i-2,.. to build the rest of state
         # but here we actually want to start at K-1 + startindex to shift to startindex 
-        rand_indices = np.array(list(range(K-1+startindex, binaryneurons.shape[1] - skipby, 2)))
+        rand_indices = np.arange(K-1+startindex, binaryneurons.shape[1] - skipby, 2)
         #print(rand_indices)
-        for i in rand_indices:
-            curr_state = binaryneurons[:,i-(K-1):(i+1)]
-            i_c = TPMMaker.get_TPM_index(curr_state)
-            total = sum(num_transitions[i_c,:])
-            if total >= required_obs:   # don't add this observation if we already have enough
-                continue
+        codes = TPMMaker.encode_states(binaryneurons, K).astype(np.int64)
+        curr = codes[rand_indices - (K-1)]
+        future = codes[rand_indices - (K-1) + skipby]
+        num_transitions = TPMMaker.get_capped_transitions(curr, future, size, required_obs)
+        
+        TPM = TPMMaker.normalise_transitions(num_transitions, required_obs)
+        return TPM, num_transitions
 
-            future_state = binaryneurons[:,i-(K-1) + skipby:(i+1) + skipby]   # Ugly indexing 
-            i_f = TPMMaker.get_TPM_index(future_state)
+    @staticmethod
+    def get_TPMs_nonbinary(binaryneurons, K, skips, required_obs, base=2, sparse=None):
+        """
+        Same as calling get_TPM_nonbinary once for each skip in skips, 
+        but the states of the binarised trains are encoded once and reused for every skip.
 
-            num_transitions[i_c, i_f] += 1
-        
-        for j in range(num_transitions.shape[0]):
-            total = sum(num_transitions[j,:])
-            if total < required_obs:
-                raise ValueError("State with index " + str(j) + \
-                " was observed in the data fewer than " + str(required_obs) + " times, (" + str(total) + " times only).")
-            
-            TPM[j,:] = num_transitions[j,:] / total
-        
+        Returns:
+            - An array of TPMs of shape (len(skips), num states, num states)
+            - The matching array of num_transitions matrices
+        If some state was observed fewer than required_obs times for a skip, 
+        that skip's TPM is all NaN, rather than a ValueError being raised for every skip.
+        With sparse matrices (see get_TPM_nonbinary), lists are returned instead of arrays,
+        and a skip that failed has None as its TPM. By default they are used if the dense arrays 
+        of all the skips together would exceed TPMMaker.DENSE_MEMORY_BUDGET.
+        """
+        binaryneurons = Raster.as_array(binaryneurons)
+        assert K >= 1
+        assert binaryneurons.shape[0] >= 1
+
+        size = (base**K)**binaryneurons.shape[0]
+        sparse = TPMMaker.use_sparse(size, sparse, num_TPMs=len(skips))
+        codes = TPMMaker.encode_states(binaryneurons, K, base).astype(np.int64)
+
+        if sparse:
+            TPMs, num_transitions = [None] * len(skips), [None] * len(skips)
+        else:
+            TPMs = np.zeros((len(skips), size, size))
+            num_transitions = np.zeros((len(skips), size, size))
+        for j in range(len(skips)):
+            # same sampling as get_TPM_nonbinary, see there
+            rand_indices = np.arange(K-1, binaryneurons.shape[1] - skips[j])
+            np.random.shuffle(rand_indices)
+            curr = codes[rand_indices - (K-1)]
+            future = codes[rand_indices - (K-1) + skips[j]]
+            num_transitions[j] = TPMMaker.get_capped_transitions(curr, future, size, required_obs, sparse)
+            try:
+                TPMs[j] = TPMMaker.normalise_transitions(num_transitions[j], required_obs)
+            except ValueError:
+                TPMs[j] = None if sparse else np.nan
+        return TPMs, num_transitions
+
+    @staticmethod
+    def get_TPM_ensemble(binaryneurons, K, skipby, required_obs, base=2, statistic=None, 
+                         batch_size=8, max_replicates=200, tol=0.01, z=1.96):
+        """
+        Draws replicate TPMs from the same data, each sampled as in get_TPM_nonbinary 
+        (the first required_obs transitions out of each state in a random order), 
+        from a single encoding of the states. Each replicate only shuffles the observations of each 
+        state as far as the required_obs it keeps, so it needs memory for one index per observation.
+        Replicates stop being drawn once the mean of statistic has converged, checked every batch_size replicates: 
+        when the half-width of its confidence interval (z standard errors) is below tol for every entry,
+        or after max_replicates replicates.
+            - statistic maps a TPM to a number or an array, e.g. 
+            lambda TPM: PhiCalculator.get_micro_average_phi(TPM, verbose=False). 
+            By default it is the TPM itself, i.e. convergence of every TPM entry.
+        Raises the same ValueError as get_TPM_nonbinary if a state was observed fewer than required_obs times.
+
+        Returns:
+            - An array of the replicate TPMs, of shape (num replicates, num states, num states)
+            - An array of the statistic of each replicate
+        """
+        binaryneurons = Raster.as_array(binaryneurons)
+        assert K >= 1
+        assert binaryneurons.shape[0] >= 1
+        if statistic is None:
+            statistic = lambda TPM: TPM
+
+        size = (base**K)**binaryneurons.shape[0]
+        codes = TPMMaker.encode_states(binaryneurons, K, base).astype(np.int64)
+        indices = np.arange(K-1, binaryneurons.shape[1] - skipby)
+        curr = codes[indices - (K-1)]
+        future = codes[indices - (K-1) + skipby]
+
+        # Every replicate keeps the same number of observations of each state, only which ones changes. 
+        # So the positions kept after sorting by state are the same for every replicate.
+        order = np.argsort(curr, kind='stable')
+        sorted_curr = curr[order]
+        starts = np.flatnonzero(np.r_[True, sorted_curr[1:] != sorted_curr[:-1]])
+        counts = np.diff(np.r_[starts, len(sorted_curr)])
+        rank = np.arange(len(sorted_curr)) - np.searchsorted(sorted_curr, sorted_curr)
+        kept_positions = rank < required_obs
+
+        TPMs, stats = [], []
+        while len(TPMs) < max_replicates:
+            num = min(batch_size, max_replicates - len(TPMs))
+            for _ in range(num):
+                # a random order within each state, but only as far as its first required_obs observations: 
+                # a Fisher-Yates shuffle of every state at once, stopped after required_obs steps
+                shuffled = order.copy()
+                for k in range(min(required_obs, counts.max(initial=0))):
+                    active = counts > k
+                    i = starts[active] + k
+                    j = starts[active] + np.random.randint(k, counts[active])
+                    shuffled[i], shuffled[j] = shuffled[j], shuffled[i]
+                kept = shuffled[kept_positions]
+
+                num_transitions = TPMMaker.count_transitions(curr[kept], future[kept], size)
+                TPM = TPMMaker.normalise_transitions(num_transitions, required_obs)
+                TPMs.append(TPM)
+                stats.append(np.asarray(statistic(TPM), dtype=np.float64))
+
+            if len(stats) > 1:
+                half_width = z * np.std(stats, axis=0, ddof=1) / np.sqrt(len(stats))
+                if np.nanmax(half_width) < tol:
+                    break
+        return np.array(TPMs), np.array(stats)
+
+    @staticmethod
+    def use_sparse(size, sparse=None, num_TPMs=1):
+        """Whether num_TPMs TPMs (and their counts) with size states should be stored as sparse matrices, see get_TPM_nonbinary"""
+        if sparse is not None:
+            return sparse
+        return 2 * num_TPMs * size * size * np.dtype(np.float64).itemsize > TPMMaker.DENSE_MEMORY_BUDGET
+
+    @staticmethod
+    def count_transitions(curr, future, size, sparse=False):
+        """(size, size) matrix of the number of times each transition curr[i] -> future[i] occurs"""
+        if sparse:
+            # duplicate entries are summed on conversion to CSR
+            ones = np.ones(len(curr))
+            return scipy.sparse.coo_matrix((ones, (curr, future)), shape=(size, size)).tocsr()
+        num_transitions = np.bincount(curr * size + future, minlength=size * size)
+        return num_transitions.reshape((size, size)).astype(np.float64)
+
+    @staticmethod
+    def get_capped_transitions(curr, future, size, required_obs, sparse=False):
+        """
+        Counts the transitions curr[i] -> future[i], taken in the given order, 
+        but only the first required_obs transitions out of each current state, 
+        as the TPM builders do when walking the observations one by one.
+            - Returns a (size, size) matrix of transition counts, sparse if sparse is True.
+        """
+        # a stable sort by current state keeps the given order within each state, 
+        # so the rank of an observation within its state says whether it is one of the first required_obs
+        order = np.argsort(curr, kind='stable')
+        sorted_curr = curr[order]
+        rank = np.arange(len(sorted_curr)) - np.searchsorted(sorted_curr, sorted_curr)
+        keep = order[rank < required_obs]
+        return TPMMaker.count_transitions(curr[keep], future[keep], size, sparse)
+
+    @staticmethod
+    def normalise_transitions(num_transitions, required_obs):
+        """Turns a matrix of transition counts into a TPM, raising a ValueError
+        if any current state was observed fewer than required_obs times.
+        A sparse matrix of counts gives a sparse TPM.
+        """
+        totals = np.asarray(num_transitions.sum(axis=1)).ravel()
+        too_few = np.nonzero(totals < required_obs)[0]
+        if len(too_few) > 0:
+            j = too_few[0]
+            raise ValueError("State with index " + str(j) + \
+            " was observed in the data fewer than " + str(required_obs) + " times, (" + str(totals[j]) + " times only).")
+        if scipy.sparse.issparse(num_transitions):
+            return scipy.sparse.diags(1 / totals) @ num_transitions
+        return num_transitions / totals[:, np.newaxis]
+
+    @staticmethod
+    def get_binned_chunks(spiketrains, S, chunk_bins, overlap, max_count=None):
+        """
+        Bins spike-trains with bins of size S, chunk_bins bins at a time, so that
+        the dense raster of the whole recording is never held in memory. 
+        Yields (chunk, first_new) pairs:
+            - chunk is the binarised trains (or spike counts clipped at max_count) of one chunk, 
+            preceded by the last `overlap` bins of the previous chunk, so that a window
+            straddling a chunk boundary appears whole in the later chunk.
+            - first_new is the index into chunk of the first bin not in the previous chunk.
+        As in get_binarised_trains, the recording is not considered further than the shortest train.
+        """
+        trains = [np.sort(np.asarray(a, dtype=np.float64)) for a in spiketrains]
+        length = min(math.ceil(a.max()/S) for a in trains)
+        start = 0
+        while start < length:
+            lo, hi = max(0, start - overlap), min(length, start + chunk_bins)
+            chunk = np.zeros((len(trains), hi - lo))
+            for n in range(len(trains)):
+                # the trains are sorted, so only the spikes around the chunk need binning
+                first, last = np.searchsorted(trains[n], [(lo - 1) * S, (hi + 1) * S])
+                indices = (trains[n][first:last] / S).astype(np.int64)
+                indices = indices[(indices >= lo) & (indices < hi)] - lo
+                if max_count is None:
+                    chunk[n, indices] = 1
+                else:
+                    chunk[n] = np.minimum(np.bincount(indices, minlength=hi - lo), max_count)
+            yield chunk, start - lo
+            start = hi
+
+    @staticmethod
+    def get_chunk_transitions(chunk, first_new, K, skipby, base=2):
+        """
+        The TPM indices of the current and future states of every transition in a chunk 
+        from get_binned_chunks whose future state ends in a bin not seen in a previous chunk,
+        so that every transition of the recording is found in exactly one chunk.
+        """
+        first = max(K-1, first_new - skipby)
+        last = chunk.shape[1] - skipby
+        if last <= first:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # the state of the window ending at i is codes[i-(K-1)]
+        codes = TPMMaker.encode_states(chunk, K, base).astype(np.int64)
+        curr = codes[first-(K-1) : last-(K-1)]
+        future = codes[first-(K-1) + skipby : last-(K-1) + skipby]
+        return curr, future
+
+    @staticmethod
+    def get_num_state_occurrences_streaming(spiketrains, S, K, skipby, chunk_bins=10**6, max_count=None):
+        """Same as get_num_state_occurrences, but accumulated chunk by chunk 
+        so that memory is bounded by chunk_bins rather than by the length of the recording.
+        """
+        assert K >= 1
+        base = 2 if max_count is None else max_count + 1
+        size = (base**K)**len(spiketrains)
+
+        num_transitions = np.zeros(size)
+        for chunk, first_new in TPMMaker.get_binned_chunks(spiketrains, S, chunk_bins, K-1 + skipby, max_count):
+            curr, _ = TPMMaker.get_chunk_transitions(chunk, first_new, K, skipby, base)
+            num_transitions += np.bincount(curr, minlength=size)
+        return num_transitions
+
+    @staticmethod
+    def TPM_from_spiketrains_streaming(spiketrains, S, K, skip, required_obs, chunk_bins=10**6, max_count=None, sparse=None):
+        """
+        Same as TPM_from_spiketrains, but binning and counting chunk by chunk
+        so that memory is bounded by chunk_bins rather than by the length of the recording.
+
+        get_TPM_nonbinary keeps the first required_obs transitions out of each current state 
+        in a random order of the whole recording, which can't be known until the end. 
+        Instead, every transition gets a random key and, for each current state, only the 
+        required_obs transitions with the smallest keys seen so far are kept. 
+        This is a uniformly random subset of each state's transitions, 
+        the same distribution as the one sampled by get_TPM_nonbinary.
+        """
+        assert K >= 1
+        base = 2 if max_count is None else max_count + 1
+        size = (base**K)**len(spiketrains)
+
+        kept_curr = np.zeros(0, dtype=np.int64)
+        kept_future = np.zeros(0, dtype=np.int64)
+        kept_keys = np.zeros(0)
+        for chunk, first_new in TPMMaker.get_binned_chunks(spiketrains, S, chunk_bins, K-1 + skip, max_count):
+            curr, future = TPMMaker.get_chunk_transitions(chunk, first_new, K, skip, base)
+            curr = np.concatenate([kept_curr, curr])
+            future = np.concatenate([kept_future, future])
+            keys = np.concatenate([kept_keys, np.random.random(len(curr) - len(kept_curr))])
+
+            # sort by state and then key, and keep the first required_obs of each state
+            order = np.lexsort((keys, curr))
+            curr, future, keys = curr[order], future[order], keys[order]
+            rank = np.arange(len(curr)) - np.searchsorted(curr, curr)
+            keep = rank < required_obs
+            kept_curr, kept_future, kept_keys = curr[keep], future[keep], keys[keep]
+
+        num_transitions = TPMMaker.count_transitions(kept_curr, kept_future, size, TPMMaker.use_sparse(size, sparse))
+        TPM = TPMMaker.normalise_transitions(num_transitions, required_obs)
         return TPM, num_transitions
 
     @staticmethod
     def get_binarised_trains(spiketrains,S):
         # get the binarised spike trains for each neuron from a train of float spikes
         # create a multidimensional array of the spiketrains by not considering further than the shortest train
-        binarised_trains = [[] for _ in range(len(spiketrains))]
-        min_length = math.inf
-        for i in range(len(spiketrains)):
-            binarised_trains[i] = Neuron.binarise_spiketrain(spiketrains[i], S)
-            min_length = min(min_length, len(binarised_trains[i]))
+        return Neuron.binarise_spiketrains(spiketrains, [S])[0]
+
+    @staticmethod
+    def get_count_trains(spiketrains, S, max_count):
+        # get the spike counts per bin, clipped at max_count, for each neuron from a train of float spikes
+        # as with get_binarised_trains, don't consider further than the shortest train
+        count_trains = [Neuron.count_spiketrain(a, S, max_count) for a in spiketrains]
+        min_length = min(len(c) for c in count_trains)
+        return np.array([c[0:min_length] for c in count_trains])
+
+    @staticmethod
+    def TPM_from_spiketrains(spiketrains, S, K, skip, required_obs, max_count=None, sparse=None):
+        """
+        - If max_count is None, states are K binarised bins per neuron, 
+        so each neuron has 2^K states.
+        - Otherwise states are K bins of spike counts clipped at max_count, 
+        so each neuron has (max_count+1)^K states. 
+        For example, K=1 and max_count=2 gives 3 states per neuron (silent, firing, bursting)
+        and a 9x9 TPM for a pair, instead of the 16x16 TPM of K=2 binarised bins.
+        - See get_TPM_nonbinary for sparse.
+        """
+        if max_count is None:
+            binarised_trains = TPMMaker.get_binarised_trains(spiketrains, S)
+            return TPMMaker.get_TPM_nonbinary(binarised_trains, K, skip, required_obs, sparse=sparse)
+        count_trains = TPMMaker.get_count_trains(spiketrains, S, max_count)
+        return TPMMaker.get_TPM_nonbinary(count_trains, K, skip, required_obs, base=max_count+1, sparse=sparse)
+
+    @staticmethod
+    def TPMs_from_spiketrains(spiketrains, S, K, skips, required_obs, max_count=None, sparse=None):
+        """
+        The TPMs for every skip in skips, binarising and encoding the spike-trains only once. 
+        See get_TPMs_nonbinary for the returned stacks, and TPM_from_spiketrains for max_count.
+        """
+        if max_count is None:
+            binarised_trains = TPMMaker.get_binarised_trains(spiketrains, S)
+            return TPMMaker.get_TPMs_nonbinary(binarised_trains, K, skips, required_obs, sparse=sparse)
+        count_trains = TPMMaker.get_count_trains(spiketrains, S, max_count)
+        return TPMMaker.get_TPMs_nonbinary(count_trains, K, skips, required_obs, base=max_count+1, sparse=sparse)
+
+    @staticmethod
+    def get_TPM_powers(TPM, skips, base_skip=1):
+        """
+        The multi-step TPMs for every skip in skips, derived from the TPM for base_skip 
+        as its matrix powers TPM^(skip/base_skip), rather than estimated from the data. 
+        They equal the estimated TPMs if the system is Markov at the base_skip scale, 
+        see get_markov_deviation. Every skip must be a multiple of base_skip.
         
-        return np.array([binarised_trains[i][0:min_length] for i in range(len(binarised_trains))])   # probably slow? 
+        Returns an array of shape (len(skips), num states, num states); if TPM is all NaN 
+        (e.g. from get_TPMs_nonbinary for an infeasible skip), so is every power.
+        """
+        if any(skip % base_skip != 0 or skip < base_skip for skip in skips):
+            raise ValueError("Every skip must be a positive multiple of base_skip ({}), got {}.".format(base_skip, list(skips)))
+        TPM = Helpers.to_dense(TPM)
+        exponents = [skip // base_skip for skip in skips]
+
+        # each power is computed from the next smallest one, in ascending order of exponent
+        powers = np.empty((len(skips),) + TPM.shape)
+        power, exponent = np.eye(TPM.shape[0]), 0
+        for i in np.argsort(exponents, kind="stable"):
+            power = power @ np.linalg.matrix_power(TPM, exponents[i] - exponent)
+            exponent = exponents[i]
+            powers[i] = power
+        return powers
 
+    @staticmethod
+    def TPMs_from_spiketrains_powers(spiketrains, S, K, skips, required_obs, base_skip=None, max_count=None):
+        """
+        The TPMs for every skip in skips as matrix powers of a single TPM estimated for base_skip
+        (by default the smallest skip), see get_TPM_powers. 
+        Raises a ValueError if the base TPM cannot be estimated, as TPM_from_spiketrains does.
+        """
+        if base_skip is None:
+            base_skip = min(skips)
+        TPM, _ = TPMMaker.TPM_from_spiketrains(spiketrains, S, K, base_skip, required_obs, max_count)
+        return TPMMaker.get_TPM_powers(TPM, skips, base_skip)
 
     @staticmethod
-    def TPM_from_spiketrains(spiketrains, S, K, skip, required_obs):
-        binarised_trains = TPMMaker.get_binarised_trains(spiketrains, S)
-        return TPMMaker.get_TPM_nonbinary(binarised_trains, K, skip, required_obs)
+    def get_markov_deviation(estimated_TPMs, derived_TPMs):
+        """
+        Compares TPMs estimated from the data (e.g. TPMs_from_spiketrains) with those derived 
+        as matrix powers (e.g. TPMs_from_spiketrains_powers) for the same skips, to test the Markov assumption. 
+        Returns, for every skip, the total variation distance between the rows of the two TPMs, 
+        averaged over the rows (0 for identical TPMs, 1 at most). 
+        Skips whose estimated TPM is NaN (infeasible) give NaN.
+        """
+        estimated_TPMs = np.stack([Helpers.to_dense(TPM) for TPM in estimated_TPMs])
+        derived_TPMs = np.asarray(derived_TPMs)
+        return 0.5 * np.abs(estimated_TPMs - derived_TPMs).sum(axis=2).mean(axis=1)
 
 
+class OnlineTPMEstimator:
+    """
+    Estimates the TPM of a set of neurons from spikes that arrive over time, e.g. during acquisition.
+    States and transitions are built as in TPMMaker (K bins per state, future state skipby bins later, 
+    binarised or clipped spike counts with max_count), but the counts are updated incrementally, 
+    so each update costs O(new data) rather than O(whole recording), 
+    and the current TPM and state occurrences can be queried at any time.
+
+    Unlike get_TPM_nonbinary, which samples required_obs transitions out of each state, 
+    every observed transition is counted.
+    """
+    def __init__(self, num_neurons, S, K, skipby, max_count=None):
+        assert K >= 1
+        self.S = S
+        self.K = K
+        self.skipby = skipby
+        self.max_count = max_count
+        self.base = 2 if max_count is None else max_count + 1
+        self.size = (self.base**K)**num_neurons
+
+        self.num_transitions = np.zeros((self.size, self.size))
+        self.num_bins = 0   # number of bins that are complete and have been counted
+        # the last K-1+skipby complete bins, which start the windows of transitions not yet counted
+        self._tail = np.zeros((num_neurons, 0))
+        # bin indices of the spikes received in bins that are not complete yet
+        self._pending = [np.zeros(0, dtype=np.int64) for _ in range(num_neurons)]
+
+    def update(self, new_spiketrains, until):
+        """
+        Adds new spikes and counts every transition that can now be seen.
+            - new_spiketrains has, for each neuron, the times of its spikes since the last update. 
+            - until is the time up to which all spikes have been received, so that every bin 
+            ending before it is complete. Spikes in bins that were already complete are ignored.
+        """
+        for n in range(len(self._pending)):
+            indices = (np.asarray(new_spiketrains[n], dtype=np.float64) / self.S).astype(np.int64)
+            self._pending[n] = np.concatenate([self._pending[n], indices[indices >= self.num_bins]])
+
+        num_bins = int(until / self.S)
+        if num_bins <= self.num_bins:
+            return
+
+        # bin the newly completed bins
+        chunk = np.zeros((len(self._pending), num_bins - self.num_bins))
+        for n in range(len(self._pending)):
+            complete = self._pending[n] < num_bins
+            indices = self._pending[n][complete] - self.num_bins
+            if self.max_count is None:
+                chunk[n, indices] = 1
+            else:
+                chunk[n] = np.minimum(np.bincount(indices, minlength=chunk.shape[1]), self.max_count)
+            self._pending[n] = self._pending[n][~complete]
+
+        window = np.concatenate([self._tail, chunk], axis=1)
+        curr, future = TPMMaker.get_chunk_transitions(window, self._tail.shape[1], self.K, self.skipby, self.base)
+        self.num_transitions += TPMMaker.count_transitions(curr, future, self.size)
+
+        overlap = self.K - 1 + self.skipby
+        # an update of fewer than overlap bins keeps the whole window
+        self._tail = window[:, max(0, window.shape[1] - overlap):] if overlap > 0 else window[:, :0]
+        self.num_bins = num_bins
+
+    @property
+    def state_occurrences(self):
+        """The number of observed transitions out of each state"""
+        return self.num_transitions.sum(axis=1)
+
+    def get_TPM(self, required_obs=1):
+        """The current TPM, raising a ValueError as get_TPM_nonbinary does 
+        if any state has been observed fewer than required_obs times so far.
+        """
+        return TPMMaker.normalise_transitions(self.num_transitions, required_obs)
+
 class CoarseGrainer:
 
     @staticmethod
@@ -234,115 +911,1077 @@ class CoarseGrainer:
         However, we don't have to coarsegrain to binary. We might say that the first state
         of each element will map to OFF, the second and third will map to FIRING, 
         fourth to BURSTING. 
+
+        The macro TPM entry [i,j] is the probability of going to any micro state of j, 
+        averaged over the micro states of i. With G the grouping matrix of state_map 
+        (see get_grouping_matrix) and A the same with each column divided by its sum, 
+        this is the matrix product A^T TPM G.
         """
         num_states = 1
         for i in num_states_per_elem:
             num_states *= i
 
-        new_TPM = np.zeros((num_states, num_states))
-        for i in range(num_states):
-            input_micro_indices = state_map[i]
-            for j in range(num_states):
-                output_micro_indices = state_map[j]
-                
-                total_prob = 0
-                """
-                for output_state in output_micro_indices:
-                    avg_for_output_state = 0
-                    for input_state in input_micro_indices:
-                        avg_for_output_state += TPM[input_state, output_state]
-
-                    avg_for_output_state = avg_for_output_state / len(input_micro_indices)
-                    total_prob += avg_for_output_state
-                """
-                for input_state in input_micro_indices:
-                    total_for_input_state = 0
-                    for output_state in output_micro_indices:
-                        total_for_input_state += TPM[input_state, output_state]
-                    
-                    total_prob += total_for_input_state
-                new_TPM[i,j] = total_prob / len(input_micro_indices)
-                
-        return new_TPM
+        grouping = CoarseGrainer.get_grouping_matrix(state_map, TPM.shape[0], num_states)
+        averaging = grouping / grouping.sum(axis=0)
+        return averaging.T @ np.asarray(TPM @ grouping)
 
     @staticmethod
-    def get_state_map(coarse_grain):
-        """Get the map from each micro state to its macro state
-        IMPORTANT: Works only for coarse grainings of pairs of neurons! 
+    def coarse_grain_nonbinary_TPMs(TPMs, state_maps, num_states_per_elems):
         """
-        assert len(coarse_grain) == 2, "Require exactly 2 elements"
-        
-        num_micro_states_per_elem = []
-        num_macro_states = 1
-        for elem in coarse_grain:
-            num_macro_states *= len(elem)
-            num_micro_states_per_elem.append(sum(len(x) for x in elem))
+        Coarse-grains a micro TPM, or a stack of micro TPMs of shape (num TPMs, num states, num states), 
+        through every state map in state_maps at once (see coarse_grain_nonbinary_TPM).
+        The grouping matrices of all state maps are concatenated, so the whole batch is 
+        a single pair of matrix products, and each macro TPM is a diagonal block of the result.
 
-        
-        new_coarse_grain = []
-        for elem in coarse_grain:
-            states = []
-            for s in range(len(elem)):
-                states.append((elem[s], s))
-            new_coarse_grain.append(states)
+        Returns a list with the macro TPM (or stack of macro TPMs) of each state map.
+        """
+        TPMs = Helpers.to_dense(TPMs)
+        groupings = []
+        for state_map, num_states_per_elem in zip(state_maps, num_states_per_elems):
+            num_states = int(np.prod(num_states_per_elem))
+            groupings.append(CoarseGrainer.get_grouping_matrix(state_map, TPMs.shape[-1], num_states))
+        grouping = np.concatenate(groupings, axis=1)
+        averaging = grouping / grouping.sum(axis=0)
+        all_macro = averaging.T @ TPMs @ grouping
+
+        macro_TPMs = []
+        start = 0
+        for g in groupings:
+            stop = start + g.shape[1]
+            macro_TPMs.append(all_macro[..., start:stop, start:stop])
+            start = stop
+        return macro_TPMs
 
-        # for every element pair
+    @staticmethod
+    def get_grouping_matrix(state_map, num_micro_states, num_macro_states=None):
+        """
+        The (num_micro_states, num_macro_states) matrix G with G[m, M] = 1 
+        if micro state m is one of the micro states of macro state M in state_map, 0 otherwise.
+        """
+        if num_macro_states is None:
+            num_macro_states = len(state_map)
+        grouping = np.zeros((num_micro_states, num_macro_states))
+        for macro_state in range(num_macro_states):
+            grouping[state_map[macro_state], macro_state] = 1
+        return grouping
+
+    @staticmethod
+    def get_state_map(coarse_grain):
+        """Get the map from each macro state to the micro states it groups, for any number of elements.
+            - coarse_grain has one grouping of micro states per element, e.g. [[[0], [1,2,3]], [[0], [1,2], [3]]]
+            - Both micro and macro states are indexed in PyPhi's little-endian order, the first element varying fastest.
+        """
+        micro_to_macro = CoarseGrainer.get_micro_to_macro(coarse_grain)
+        num_macro_states = int(np.prod([len(elem) for elem in coarse_grain]))
+
+        # group the micro states by macro state
+        order = np.argsort(micro_to_macro, kind='stable')
+        bounds = np.searchsorted(micro_to_macro[order], np.arange(num_macro_states + 1))
         state_map = {}
-        for q in range(len(new_coarse_grain[1])):
-            for p in range(len(new_coarse_grain[0])):
-                states_p = list(new_coarse_grain[0][p][0])
-                states_q = [num_micro_states_per_elem[0] * e for e in new_coarse_grain[1][q][0]]
-                
-                micro_system_states = np.add.outer(states_p, states_q).ravel()
-                macro_state = p + q * len(new_coarse_grain[0])
-                state_map[macro_state] = micro_system_states.tolist()
+        for macro_state in range(num_macro_states):
+            state_map[macro_state] = order[bounds[macro_state]:bounds[macro_state + 1]].tolist()
         return state_map
 
     @staticmethod
-    def get_state_maps(element_coarse_grainings):
-        """For a 2 element system, given coarse graining options for an element,
+    def get_micro_to_macro(coarse_grain):
+        """
+        The index table from each micro state of the system to its macro state under coarse_grain, 
+        built with vectorized outer-product indexing and cached per grouping (the returned array is read-only).
+        """
+        return CoarseGrainer._get_micro_to_macro(tuple(tuple(tuple(block) for block in elem) for elem in coarse_grain))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _get_micro_to_macro(coarse_grain):
+        micro_to_macro = np.zeros((), dtype=np.int64)
+        macro_stride = 1
+        for elem in coarse_grain:
+            # macro state of each of this element's micro states
+            labels = np.zeros(sum(len(block) for block in elem), dtype=np.int64)
+            for macro_state, block in enumerate(elem):
+                labels[list(block)] = macro_state
+            # later elements go on earlier axes, so that raveling gives the little-endian micro index
+            micro_to_macro = np.add.outer(labels * macro_stride, micro_to_macro)
+            macro_stride *= len(elem)
+        micro_to_macro = micro_to_macro.ravel()
+        micro_to_macro.flags.writeable = False
+        return micro_to_macro
+
+    @staticmethod
+    def get_state_maps(element_coarse_grainings, num_elements=2):
+        """For a system of num_elements elements, given coarse graining options for an element,
            get the state maps for each coarse graining combination"""
         states = []
         num_states_l = []
-        for e1 in element_coarse_grainings:
-            for e2 in element_coarse_grainings:
-                c_state_map = CoarseGrainer.get_state_map([e1, e2])
-                c_num_states = [len(e) for e in [e1,e2]]
+        for coarse_grain in itertools.product(element_coarse_grainings, repeat=num_elements):
+            c_state_map = CoarseGrainer.get_state_map(coarse_grain)
+            c_num_states = [len(e) for e in coarse_grain]
 
-                states.append(c_state_map)
-                num_states_l.append(c_num_states)
+            states.append(c_state_map)
+            num_states_l.append(c_num_states)
         return states, num_states_l
 
+    @staticmethod
+    def get_element_partitions(num_states, order_preserving=False):
+        """
+        Generates every way of grouping an element's num_states micro states into macro states,
+        i.e. every set partition of range(num_states), including non-contiguous groupings such as [[0,2],[1,3]]. 
+            - If order_preserving, only groupings into contiguous runs, such as [[0],[1,2],[3]], are generated.
+        Partitions are lists of blocks, sorted by their smallest state. They are generated lazily, 
+        from the finest partition downwards, each obtained by one merge from one generated before it.
+        """
+        finest = tuple((state,) for state in range(num_states))
+        stack = [finest]
+        while stack:
+            partition = stack.pop()
+            yield [list(block) for block in partition]
+            for child, _ in reversed(CoarseGrainer._get_partition_children(partition, order_preserving)):
+                stack.append(child)
+
+    @staticmethod
+    def _get_partition_children(partition, order_preserving):
+        """
+        The children of a partition in a spanning tree of the refinement lattice, 
+        so that every partition has exactly one parent: 
+        a child merges a singleton {m} into an earlier block, where m is larger than every state 
+        that is not the smallest of its block. Returns (child, labels) pairs, where labels[j]
+        is the index in the child of the parent's block j.
+        """
+        non_leaders = [state for block in partition for state in block[1:]]
+        largest_non_leader = max(non_leaders, default=-1)
+        children = []
+        for i_m in range(len(partition)):
+            if len(partition[i_m]) != 1 or partition[i_m][0] < largest_non_leader:
+                continue
+            m = partition[i_m][0]
+            for i_b in range(i_m):   # blocks are sorted by their smallest state, so these start before m
+                if order_preserving and partition[i_b][-1] != m - 1:
+                    continue
+                merged = tuple(sorted(partition[i_b] + (m,)))
+                child = partition[:i_b] + (merged,) + partition[i_b+1:i_m] + partition[i_m+1:]
+                labels = [j if j < i_m else (i_b if j == i_m else j - 1) for j in range(len(partition))]
+                children.append((child, labels))
+        return children
+
+    @staticmethod
+    def all_coarse_grainings(micro_TPM, num_states_per_elem, order_preserving=False):
+        """
+        Lazily generates every coarse-graining of a system, with its macro TPM: 
+        every combination of a partition of each element's micro states (see get_element_partitions),
+        starting with the micro system itself. 
+        Yields (coarse_grain, num_states_per_elem, macro_TPM) tuples, where coarse_grain 
+        can be passed to get_state_map. 
+
+        Each macro TPM is derived from the macro TPM of its parent in the refinement lattice, 
+        which differs from it by a single merge, rather than from the micro TPM. 
+        Only the chain of ancestors of the current coarse-graining is held in memory. 
+        """
+        finest = [tuple((state,) for state in range(n)) for n in num_states_per_elem]
+        yield from CoarseGrainer._coarse_grainings_from(finest, Helpers.to_dense(micro_TPM), 0, order_preserving)
+
+    @staticmethod
+    def _coarse_grainings_from(coarse_grain, macro_TPM, first_elem, order_preserving):
+        yield [[list(block) for block in elem] for elem in coarse_grain], [len(elem) for elem in coarse_grain], macro_TPM
+        # only change elements from first_elem on, so that every combination is generated once
+        for n in range(first_elem, len(coarse_grain)):
+            for child, labels in CoarseGrainer._get_partition_children(coarse_grain[n], order_preserving):
+                child_grain = coarse_grain[:n] + [child] + coarse_grain[n+1:]
+                child_TPM = CoarseGrainer._merge_macro_TPM(macro_TPM, coarse_grain, n, labels)
+                yield from CoarseGrainer._coarse_grainings_from(child_grain, child_TPM, n, order_preserving)
+
+    @staticmethod
+    def _merge_macro_TPM(macro_TPM, coarse_grain, n, labels):
+        """
+        The macro TPM after merging blocks of element n of coarse_grain, as given by labels, 
+        computed from the macro TPM of coarse_grain. 
+        Averaging over a merged macro state's micro states is the average over its parts
+        weighted by how many micro states each part groups. 
+        """
+        groupings = []
+        for k in range(len(coarse_grain)):
+            if k == n:
+                groupings.append([[j for j in range(len(labels)) if labels[j] == c] for c in range(max(labels) + 1)])
+            else:
+                groupings.append([[j] for j in range(len(coarse_grain[k]))])
+        parent_to_child = CoarseGrainer.get_micro_to_macro(groupings)
+        num_child_states = int(np.prod([len(g) for g in groupings]))
+
+        grouping = np.zeros((len(parent_to_child), num_child_states))
+        grouping[np.arange(len(parent_to_child)), parent_to_child] = 1
+
+        # number of micro states in each of the parent's macro states, in the same order as get_micro_to_macro
+        sizes = np.ones(())
+        for elem in coarse_grain:
+            sizes = np.multiply.outer([len(block) for block in elem], sizes)
+        averaging = grouping * sizes.ravel()[:, np.newaxis]
+        averaging /= averaging.sum(axis=0)
+        return averaging.T @ macro_TPM @ grouping
+
+    @staticmethod
+    def get_permuted_TPM(TPM, num_states_per_elem, permutation):
+        """
+        The TPM of the same system with its elements relabelled, so that element k of the 
+        returned TPM is element permutation[k] of TPM. Returns (permuted TPM, its num_states_per_elem).
+        """
+        num_elems = len(num_states_per_elem)
+        permuted_num_states = [num_states_per_elem[p] for p in permutation]
+        # the value of each (permuted) element in each permuted state, element 0 varying fastest
+        digits = np.indices(permuted_num_states[::-1]).reshape(num_elems, -1)[::-1]
+        strides = np.cumprod([1] + list(num_states_per_elem[:-1]))
+        old_indices = sum(digits[k] * strides[permutation[k]] for k in range(num_elems))
+        return TPM[np.ix_(old_indices, old_indices)], permuted_num_states
+
+    @staticmethod
+    def get_canonical_form(TPM, num_states_per_elem, decimals=12):
+        """
+        Of the TPMs obtained by relabelling the elements of TPM, the one with the smallest key, where 
+        the key is its num_states_per_elem and its entries rounded to decimals. 
+        TPMs that are equal up to a permutation of their elements have the same key.
+        Returns (key, canonical TPM, its num_states_per_elem, permutation), see get_permuted_TPM.
+        """
+        TPM = Helpers.to_dense(TPM)
+        best = None
+        for permutation in itertools.permutations(range(len(num_states_per_elem))):
+            permuted_TPM, permuted_num_states = CoarseGrainer.get_permuted_TPM(TPM, num_states_per_elem, permutation)
+            key = (tuple(permuted_num_states), (np.round(permuted_TPM, decimals) + 0.0).tobytes())
+            if best is None or key < best[0]:
+                best = (key, permuted_TPM, permuted_num_states, permutation)
+        return best
+
+class PhiCache:
+    """
+    On-disk cache of state phis, shared by runs and worker processes, in an SQLite database at path. 
+    An entry is keyed by a hash of its TPM (rounded to decimals), num_states_per_node, state, 
+    and the pyphi.config options in PhiCache.CONFIG_OPTIONS, so the same TPM reached through different 
+    iterations, re-runs or coarse-grainings is only computed once, and changing those options never gives stale phis.
+
+    At most max_entries entries are kept; beyond that, the least recently used ones are evicted. 
+    SQLite's file locking makes it safe for concurrent worker processes (each opens its own connection). 
+    Enable it for PhiCalculator with PhiCalculator.cache = PhiCache(path).
+    """
+    CONFIG_OPTIONS = ["MEASURE", "PARTITION_TYPE", "ASSUME_CUTS_CANNOT_CREATE_NEW_CONCEPTS", 
+                      "USE_SMALL_PHI_DIFFERENCE_FOR_CES_DISTANCE", "CUT_ONE_APPROXIMATION", "SYSTEM_CUTS", 
+                      "SINGLE_MICRO_NODES_WITH_SELFLOOPS_HAVE_PHI", "PRECISION"]
+
+    def __init__(self, path, max_entries=10**6, decimals=10):
+        self.path = path
+        self.max_entries = max_entries
+        self.decimals = decimals
+        self._connection = None
+        self._pid = None
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS phis (key TEXT PRIMARY KEY, phi REAL, last_used REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS phis_last_used ON phis (last_used)")
+
+    def connect(self):
+        # connections must not be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=600)
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_connection"], state["_pid"] = None, None
+        return state
+
+    def get_keys(self, TPM, num_states_per_node, states):
+        """The key of each state of the network with the given TPM"""
+        h = hashlib.sha256()
+        h.update((np.round(Helpers.to_dense(TPM).astype(np.float64), self.decimals) + 0.0).tobytes())
+        h.update(repr([int(n) for n in num_states_per_node]).encode())
+        h.update(repr([(option, getattr(pyphi.config, option, None)) for option in PhiCache.CONFIG_OPTIONS]).encode())
+        keys = []
+        for state in states:
+            state_h = h.copy()
+            state_h.update(repr(tuple(int(x) for x in state)).encode())
+            keys.append(state_h.hexdigest())
+        return keys
+
+    def get_many(self, keys):
+        """Dictionary of the cached phi of each key that is in the cache"""
+        phis = {}
+        connection = self.connect()
+        with connection:
+            for i in range(0, len(keys), 500):   # stay below SQLite's limit on query parameters
+                chunk = keys[i:i+500]
+                rows = connection.execute(
+                    "SELECT key, phi FROM phis WHERE key IN ({})".format(",".join("?" * len(chunk))), chunk).fetchall()
+                # SQLite stores NaN as NULL
+                phis.update((key, float("nan") if phi is None else phi) for key, phi in rows)
+                connection.execute(
+                    "UPDATE phis SET last_used = ? WHERE key IN ({})".format(",".join("?" * len(chunk))), [time.time()] + chunk)
+        return phis
+
+    def put_many(self, phis):
+        """Add a dictionary of phis by key to the cache, evicting the least recently used entries beyond max_entries"""
+        connection = self.connect()
+        with connection:
+            now = time.time()
+            connection.executemany("INSERT OR REPLACE INTO phis VALUES (?, ?, ?)", 
+                                   [(key, float(phi), now) for key, phi in phis.items()])
+            num_entries = connection.execute("SELECT COUNT(*) FROM phis").fetchone()[0]
+            if num_entries > self.max_entries:
+                connection.execute("DELETE FROM phis WHERE key IN (SELECT key FROM phis ORDER BY last_used LIMIT ?)", 
+                                   (num_entries - self.max_entries,))
+
+class StateRepertoireCache(pyphi.cache.DictCache):
+    """
+    A repertoire cache for the Subsystem of one state, whose entries are shared 
+    with the Subsystems of the other states of the same network (through the dictionary cache). 
+    Repertoires only depend on the state of the mechanism's nodes, so that part of the state 
+    is added to the key, and a repertoire computed for one state is reused for every state 
+    that agrees with it on the mechanism.
+    """
+    def __init__(self, cache, state):
+        super().__init__()
+        self.cache = cache
+        self.state = tuple(state)
+
+    def key(self, *args, _prefix=None, **kwargs):
+        # the first argument is the mechanism, or a mechanism node index for single-node repertoires
+        mechanism = args[0]
+        mechanism = (mechanism,) if isinstance(mechanism, (int, np.integer)) else tuple(sorted(mechanism))
+        mechanism_state = tuple(self.state[m] for m in mechanism)
+        return super().key(*args, _prefix=(_prefix, mechanism_state), **kwargs)
+
+class StateBatchedSubsystem(pyphi.Subsystem):
+    """
+    A Subsystem that shares its repertoires and the MIPs of its mechanisms with the subsystems 
+    of the other states of the same network, and so do its cut subsystems, through shared (a dictionary).
+    Both only depend on the state of the mechanism's nodes (see StateRepertoireCache), 
+    so they are computed once per state of the mechanism rather than once per state of the system.
+    A cut subsystem also reuses the MIPs of the uncut subsystem when the cut severs no connection 
+    from the purview to the mechanism (cause) or from the mechanism to the purview (effect).
+    """
+    def __init__(self, network, state, nodes=None, cut=None, mice_cache=None, shared=None):
+        if shared is None:
+            shared = {}
+        repertoires, single_node_repertoires = shared.setdefault(cut, ({}, {}))
+        super().__init__(network, state, nodes=nodes, cut=cut, mice_cache=mice_cache, 
+            repertoire_cache=StateRepertoireCache(repertoires, state), 
+            single_node_repertoire_cache=StateRepertoireCache(single_node_repertoires, state))
+        self._shared = shared
+        self._mips = shared.setdefault("mips", {})
+        self._cut_matrix = self.cut.cut_matrix(network.size)
+
+    def apply_cut(self, cut):
+        return StateBatchedSubsystem(self.network, self.state, self.node_indices, 
+                                     cut=cut, mice_cache=self._mice_cache, shared=self._shared)
+
+    def find_mip(self, direction, mechanism, purview):
+        sources, targets = (purview, mechanism) if direction == pyphi.Direction.CAUSE else (mechanism, purview)
+        cut = self.cut if self._cut_matrix[np.ix_(list(sources), list(targets))].any() else None
+        key = (cut, direction, tuple(mechanism), tuple(purview), tuple(self.state[m] for m in mechanism))
+        if key not in self._mips:
+            self._mips[key] = super().find_mip(direction, mechanism, purview)
+        return self._mips[key]
+
+class TwoElementSIA:
+    """
+    The system irreducibility analysis of a network of 2 elements (with any number of states each), 
+    computing the same big phi as pyphi.compute.sia for the configured MEASURE and PARTITION_TYPE, 
+    but directly on numpy arrays rather than through pyphi's Subsystem, Concept and SIA objects. 
+    
+    The elements' TPMs, those of the 2 cut systems, the candidate purviews and the partitions 
+    do not depend on the state, so they are built once per network; MIPs are shared between states
+    that agree on the mechanism's state (see StateBatchedSubsystem). 
+    Small phi is pyphi's own pyphi.distance.repertoire_distance, and the rules pyphi uses to pick
+    purviews and cuts, and to reuse the uncut MICE in the cut systems, are followed, so results match pyphi's. 
+
+    Only supports big phi as the difference in the sum of small phi (USE_SMALL_PHI_DIFFERENCE_FOR_CES_DISTANCE)
+    and IIT 3.0 system cuts, see supports. PhiCalculator falls back to pyphi otherwise.
+    """
+    MECHANISMS = [(0,), (1,), (0, 1)]
+    PURVIEWS = [(0,), (1,), (0, 1)]
+    CUTS = [(0, 1), (1, 0)]   # (from, to): the connection from node `from` to node `to` is cut
+
+    # pyphi's small phi measures, batched: the distance of a flattened repertoire p to each row of qs. 
+    # Each is checked against pyphi's own measure before it is used (see get_batched_measure), 
+    # otherwise, e.g. for EMD, pyphi.distance.repertoire_distance is called for each partition.
+    BATCHED_MEASURES = {
+        'L1': lambda p, qs: np.absolute(p - qs).sum(axis=1),
+        'KLD': lambda p, qs: scipy.special.rel_entr(p / p.sum(), qs / qs.sum(axis=1, keepdims=True)).sum(axis=1) / np.log(2.0),
+        'KLM': lambda p, qs: np.abs(p * np.nan_to_num(np.log(p / qs))).max(axis=1),
+        'BLD': lambda p, qs: np.abs(p * np.nan_to_num(np.log(p / qs))).max(axis=1),
+        'ID': lambda p, qs: (scipy.special.rel_entr(p, qs) / np.log(2)).max(axis=1),
+        'AID': lambda p, qs: np.abs(scipy.special.rel_entr(p, qs) / np.log(2)).max(axis=1),
+    }
+    _checked_measures = {}
+
+    @staticmethod
+    def get_batched_measure():
+        """The batched version of pyphi.config.MEASURE, or None if there is none that agrees with pyphi's"""
+        measure = pyphi.config.MEASURE
+        if measure not in TwoElementSIA._checked_measures:
+            batched = TwoElementSIA.BATCHED_MEASURES.get(measure)
+            if batched is not None:
+                rng = np.random.RandomState(0)
+                pairs = [rng.rand(2, 4, 2) for _ in range(20)] + [rng.randint(0, 3, (2, 3, 3)) / 2.0 + 0.0 for _ in range(20)]
+                with np.errstate(all='ignore'):
+                    for p, q in pairs:
+                        p, q = p / p.sum(), q / max(q.sum(), 1)
+                        expected = round(float(pyphi.distance.measures[measure](p, q)), pyphi.config.PRECISION)
+                        got = round(float(batched(p.ravel(), q.reshape(1, -1))[0]), pyphi.config.PRECISION)
+                        if not (expected == got or (np.isnan(expected) and np.isnan(got))):
+                            batched = None
+                            break
+            TwoElementSIA._checked_measures[measure] = batched
+        return TwoElementSIA._checked_measures[measure]
+
+    @staticmethod
+    def supports(num_states_per_node):
+        return TwoElementSIA.get_unsupported_reason(num_states_per_node) is None
+
+    @staticmethod
+    def get_unsupported_reason(num_states_per_node):
+        """Why TwoElementSIA cannot compute the phis of a network with the current pyphi.config, or None if it can"""
+        if len(num_states_per_node) != 2:
+            return "the network has {} elements, not 2".format(len(num_states_per_node))
+        if not pyphi.config.USE_SMALL_PHI_DIFFERENCE_FOR_CES_DISTANCE:
+            return "pyphi.config.USE_SMALL_PHI_DIFFERENCE_FOR_CES_DISTANCE is off"
+        if getattr(pyphi.config, "SYSTEM_CUTS", "3.0_STYLE") != "3.0_STYLE":
+            return "pyphi.config.SYSTEM_CUTS is not '3.0_STYLE'"
+        return None
+
+    def __init__(self, TPM, num_states_per_node):
+        assert len(num_states_per_node) == 2
+        self.num_states_per_node = list(num_states_per_node)
+        # the distribution of each node's next state given the current state, with an axis per node (node 0 first)
+        node_tpms = []
+        for k, marginal in enumerate(PhiCalculator.get_node_marginals(TPM, num_states_per_node)):
+            node_tpms.append(marginal.reshape(tuple(num_states_per_node[::-1]) + (num_states_per_node[k],)).transpose(1, 0, 2))
+        # the node TPMs and connectivity matrix of the uncut system (None) and of each cut system
+        self.systems = {None: (node_tpms, np.ones((2, 2), dtype=int))}
+        for source, target in TwoElementSIA.CUTS:
+            cut_tpms = list(node_tpms)
+            cut_tpms[target] = TwoElementSIA.marginalize_out([source], node_tpms[target])
+            cm = np.ones((2, 2), dtype=int)
+            cm[source, target] = 0
+            self.systems[(source, target)] = (cut_tpms, cm)
+        self._partitions = {}
+        self._purviews = {}
+        self._mips = {}
+
+    @staticmethod
+    def marginalize_out(nodes, tpm):
+        return tpm.sum(tuple(nodes), keepdims=True) / np.array(tpm.shape)[list(nodes)].prod()
+
+    def get_repertoire(self, cut, direction, mechanism, purview, state):
+        """The cause or effect repertoire of mechanism over purview, shaped as pyphi's"""
+        if not purview:
+            return np.array([1.0])
+        node_tpms, _ = self.systems[cut]
+        shape = [n if i in purview else 1 for i, n in enumerate(self.num_states_per_node)]
+        non_purview = [i for i in range(2) if i not in purview]
+        joint = np.ones(shape)
+        if direction == pyphi.Direction.CAUSE:
+            if not mechanism:
+                return joint / joint.size
+            single_node_repertoires = []
+            for m in mechanism:
+                tpm = node_tpms[m][..., state[m]]
+                single_node_repertoires.append(TwoElementSIA.marginalize_out(non_purview, tpm) if non_purview else tpm)
+            joint *= functools.reduce(np.multiply, single_node_repertoires)
+            total = joint.sum()
+            return joint if total == 0 else joint / total
+
+        single_node_repertoires = []
+        for p in purview:
+            tpm = node_tpms[p]
+            # condition on the mechanism nodes that are inputs of p (not cut), and marginalize out the others
+            index = [slice(state[i], state[i] + 1) if i in mechanism and tpm.shape[i] > 1 else slice(None) for i in range(2)]
+            tpm = tpm[tuple(index)]
+            non_mechanism = [i for i in range(2) if i not in mechanism and tpm.shape[i] > 1]
+            if non_mechanism:
+                tpm = TwoElementSIA.marginalize_out(non_mechanism, tpm)
+            single_node_repertoires.append(tpm.reshape([n if i == p else 1 for i, n in enumerate(self.num_states_per_node)]))
+        return joint * functools.reduce(np.multiply, single_node_repertoires)
+
+    def get_partitions(self, mechanism, purview):
+        key = (mechanism, purview, pyphi.config.PARTITION_TYPE)
+        if key not in self._partitions:
+            self._partitions[key] = [[(part.mechanism, part.purview) for part in partition] 
+                                     for partition in pyphi.partition.mip_partitions(mechanism, purview)]
+        return self._partitions[key]
+
+    def get_purviews(self, cut, direction, mechanism):
+        """The purviews that are not trivially reducible, in pyphi's order"""
+        key = (cut, direction, mechanism)
+        if key not in self._purviews:
+            cm = self.systems[cut][1]
+            self._purviews[key] = [purview for purview in TwoElementSIA.PURVIEWS 
+                                   if not pyphi.connectivity.block_reducible(cm, *direction.order(mechanism, purview))]
+        return self._purviews[key]
+
+    def get_mip_phi(self, cut, direction, mechanism, purview, state):
+        """The small phi of the MIP of mechanism over purview, see pyphi.Subsystem.find_mip"""
+        key = (cut, direction, mechanism, purview, tuple(state[m] for m in mechanism))
+        if key in self._mips:
+            return self._mips[key]
+        repertoire = self.get_repertoire(cut, direction, mechanism, purview, state)
+        if direction == pyphi.Direction.CAUSE and np.all(repertoire == 0):
+            self._mips[key] = 0   # unreachable state
+            return 0
+        partitioned_repertoires = [
+            functools.reduce(np.multiply, [self.get_repertoire(cut, direction, part_mechanism, part_purview, state) 
+                                           for part_mechanism, part_purview in partition])
+            for partition in self.get_partitions(mechanism, purview)]
+
+        batched = TwoElementSIA.get_batched_measure()
+        if batched is None:
+            phis = [pyphi.distance.repertoire_distance(direction, repertoire, partitioned) for partitioned in partitioned_repertoires]
+        else:
+            with np.errstate(all='ignore'):
+                phis = batched(repertoire.ravel(), np.stack([np.broadcast_to(partitioned, repertoire.shape).ravel() 
+                                                             for partitioned in partitioned_repertoires]))
+        # the MIP is the partition with the smallest phi (rounding commutes with the minimum)
+        phi = round(float(min(phis, default=float("inf"))), pyphi.config.PRECISION)
+        self._mips[key] = phi
+        return phi
+
+    def get_mice(self, cut, direction, mechanism, state):
+        """The (phi, purview) of the MIC or MIE, breaking ties between purviews as pyphi does"""
+        best = (0.0, ())
+        best_order = None
+        for purview in self.get_purviews(cut, direction, mechanism):
+            phi = self.get_mip_phi(cut, direction, mechanism, purview, state)
+            order = (phi, -len(purview) if getattr(pyphi.config, "PICK_SMALLEST_PURVIEW", False) else len(purview))
+            if best_order is None or order > best_order:
+                best, best_order = (phi, purview), order
+        return best
+
+    def get_concept_phi(self, cut, mechanism, state):
+        phis = []
+        for direction in [pyphi.Direction.CAUSE, pyphi.Direction.EFFECT]:
+            if cut is not None:
+                # as pyphi's MICE cache, the uncut MICE is kept if it has phi and the cut does not affect it
+                phi, purview = self.get_mice(None, direction, mechanism, state)
+                sources, targets = direction.order(mechanism, purview)
+                damaged = len(mechanism) > 1 or (cut[0] in sources and cut[1] in targets)
+                if phi > 0 and not damaged:
+                    phis.append(phi)
+                    continue
+            phis.append(self.get_mice(cut, direction, mechanism, state)[0])
+        return min(phis)
+
+    def get_phi(self, state):
+        """Big phi of the network in state, see pyphi.compute.sia"""
+        state = tuple(state)
+        unpartitioned = [(mechanism, self.get_concept_phi(None, mechanism, state)) for mechanism in TwoElementSIA.MECHANISMS]
+        unpartitioned = [(mechanism, phi) for mechanism, phi in unpartitioned if phi > 0]
+        if not unpartitioned:
+            return 0.0
+        unpartitioned_mechanisms = [mechanism for mechanism, _ in unpartitioned]
+        if pyphi.config.ASSUME_CUTS_CANNOT_CREATE_NEW_CONCEPTS:
+            mechanisms = unpartitioned_mechanisms
+        else:
+            # both cuts split the mechanism of both nodes
+            mechanisms = set(unpartitioned_mechanisms + [(0, 1)])
+        
+        big_phi = float("inf")
+        for cut in TwoElementSIA.CUTS:
+            partitioned = [self.get_concept_phi(cut, mechanism, state) for mechanism in mechanisms]
+            phi = round(sum(phi for _, phi in unpartitioned) - sum(phi for phi in partitioned if phi > 0), pyphi.config.PRECISION)
+            if phi == 0:
+                return phi
+            big_phi = min(big_phi, phi)
+        return big_phi
+
+class SIABudgetExceeded(Exception):
+    """Raised when an SIA runs out of its time or memory budget, see PhiCalculator.run_with_budget"""
+    pass
+
+
+def _raise_time_budget_exceeded(signum, frame):
+    raise SIABudgetExceeded("time budget exceeded")
+
+
+def _stop_time_budget(previous_handler):
+    # the repeating alarm may still go off while it is being stopped, until the handler is replaced
+    while True:
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+            return
+        except SIABudgetExceeded:
+            pass
+
+
+class PhiPool:
+    """
+    Computes state phis in a pool of worker processes, for workstations with many cores but no MPI. 
+    Enable it with PhiCalculator.pool = PhiPool(); PhiCalculator then fans the states of its networks out 
+    to the pool, and returns the phis in the same order and layout as without it.
+        - Each task is a (TPM, num_states_per_node, states) triple: states_per_task consecutive states of one network 
+        (by default, the states of all networks split evenly over the processes), so the states of a task 
+        still share their repertoires and MIPs (see StateBatchedSubsystem).
+        - Tasks are submitted chunksize at a time (see multiprocessing.Pool.map). 
+        - Every task carries a snapshot of pyphi.config and of PhiCalculator's settings (PhiPool.SETTINGS), 
+        so the workers compute with the settings of the calling process, wherever those were changed, 
+        except that pyphi's own parallelism is always off in the workers.
+        - Networks that PhiCalculator.scheduling gives inner parallelism are not sent to the pool, 
+        but computed one after another in the calling process once the pool is done, with pyphi's own parallelism.
+    The processes are started on first use; close() (or a with block) stops them.
+    """
+
+    SETTINGS = ["backend", "cache", "sia_time_budget", "sia_memory_budget"]
+
+    def __init__(self, processes=None, states_per_task=None, chunksize=1):
+        self.processes = processes or os.cpu_count()
+        self.states_per_task = states_per_task
+        self.chunksize = chunksize
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes, initializer=_init_phi_worker)
+        return self._pool
+
+    def get_tasks(self, TPMs, num_states_l, verbose_states=None):
+        """The tasks for the states of each network, and the number of tasks of each network"""
+        all_states = [Helpers.get_system_states(num_states) for num_states in num_states_l]
+        states_per_task = self.states_per_task
+        if states_per_task is None:
+            states_per_task = math.ceil(sum(len(states) for states in all_states) / self.processes)
+        config = pyphi.config.snapshot()
+        calculator_settings = {name: getattr(PhiCalculator, name) for name in PhiPool.SETTINGS}
+        tasks, num_tasks = [], []
+        for i, states in enumerate(all_states):
+            verbose_state = None if verbose_states is None else verbose_states[i]
+            # the pool is the parallelism: pool workers are daemonic, so pyphi could not start its own processes in them
+            settings = (dict(config, PARALLEL_CUT_EVALUATION=False, PARALLEL_CONCEPT_EVALUATION=False), calculator_settings)
+            chunks = [states[start:start + states_per_task] for start in range(0, len(states), states_per_task)]
+            for chunk in chunks:
+                tasks.append((TPMs[i], num_states_l[i], chunk, verbose_state if verbose_state in chunk else None, settings))
+            num_tasks.append(len(chunks))
+        return tasks, num_tasks
+
+    def map_state_phis(self, TPMs, num_states_l, verbose_states=None, skipped=None):
+        """
+        The state phis of each network, as PhiCalculator.get_state_phis would give them. 
+            - skipped: if given a list, the skipped (state, reason) pairs of every network are appended to it, 
+            network by network.
+        """
+        if verbose_states is None:
+            verbose_states = [None] * len(TPMs)
+        inner = [PhiCalculator.get_parallelism(num_states) == 'inner' for num_states in num_states_l]
+        outer = [i for i in range(len(TPMs)) if not inner[i]]
+        tasks, num_tasks = self.get_tasks([TPMs[i] for i in outer], [num_states_l[i] for i in outer], [verbose_states[i] for i in outer])
+        results = iter(self.get_pool().map(_get_state_phis_task, tasks, chunksize=self.chunksize) if tasks else [])
+        phis, network_skipped = [None] * len(TPMs), [[] for _ in TPMs]
+        for i, n in zip(outer, num_tasks):
+            phis[i] = []
+            for _ in range(n):
+                task_phis, task_skipped = next(results)
+                phis[i] += task_phis
+                network_skipped[i] += task_skipped
+        for i in range(len(TPMs)):
+            if inner[i]:
+                with pyphi.config.override(**PhiCalculator.get_scheduled_config(num_states_l[i])):
+                    phis[i] = PhiCalculator._compute_state_phis(TPMs[i], num_states_l[i], verbose_states[i], network_skipped[i])
+        if skipped is not None:
+            for network in network_skipped:
+                skipped += network
+        return phis
+
+
+def _init_phi_worker():
+    # forked workers inherit the pool of their parent, but must compute their tasks themselves
+    PhiCalculator.pool = None
+
+
+def _get_state_phis_task(task):
+    """Computes the phis of one PhiPool task in a worker process"""
+    TPM, num_states_per_node, states, verbose_state, (config, calculator_settings) = task
+    for name, value in calculator_settings.items():
+        setattr(PhiCalculator, name, value)
+    skipped = []
+    with pyphi.config.override(**config):
+        phis = PhiCalculator._compute_state_phis(TPM, num_states_per_node, verbose_state, skipped, states)
+    return phis, skipped
+
+
 class PhiCalculator:
 
+    # optional PhiCache that get_state_phis looks phis up in before computing them
+    cache = None
+    # optional PhiPool that the phis of states are computed in
+    pool = None
+    # how each network's phis use pyphi's own parallelism, see get_parallelism: 
+    # None leaves pyphi.config as it is, 'outer' turns it off, 'inner' turns it on, 'auto' chooses per network
+    scheduling = None
+    # networks with at least this many nodes or states are large enough for inner parallelism under 'auto'
+    inner_min_nodes = 3
+    inner_min_states = 64
+    # optional number of cores for inner parallelism, e.g. the cores per rank when several MPI ranks share a node, 
+    # see get_free_cores
+    cores = None
+    # optional budgets of each SIA, in seconds and in bytes of memory, see run_with_budget
+    sia_time_budget = None
+    sia_memory_budget = None
+    # bit flags of the outcomes in the status arrays saved by get_phis: "infeasible" for configurations 
+    # without enough observations, the others for the skipped reasons of get_state_phis, see get_status
+    STATUS_FLAGS = {"infeasible": 1, "unreachable": 2, "not strongly connected": 4, 
+                    "time budget exceeded": 8, "memory budget exceeded": 16}
+    # 'pyphi', or 'two_element' to compute the phis of 2-element networks with TwoElementSIA when it supports the config
+    # (warning once for each reason it does not)
+    backend = 'pyphi'
+    _backend_warnings = set()
     @staticmethod
-    def get_micro_phis(TPM, verbose=True):
+    def get_micro_phis(TPM, verbose=True, num_states_per_node=None, skipped=None):
         """
         Gets the state phis for a TPM with 2 elements, each 4 states.
+            - num_states_per_node overrides this, e.g. [3,3] for spike-count states 
+            clipped at 2 (see TPMMaker.TPM_from_spiketrains).
+            - skipped: see get_state_phis.
         """
+        if num_states_per_node is None:
+            num_states_per_node = [4,4]
+        phis = PhiCalculator.get_state_phis(TPM, num_states_per_node, verbose_state=(0,1) if verbose else None, skipped=skipped)
+        if verbose:
+            print(phis)
+        
+        return phis
+
+    @staticmethod
+    def get_state_phis(TPM, num_states_per_node, verbose_state=None, skipped=None, states=None):
+        """
+        Gets the phi of every state of the network with the given TPM, in the order 
+        of Helpers.get_system_states(num_states_per_node) (not the TPM order!).
+            - states: only get the phis of these states, in this order.
+            - If verbose_state is one of the states, its ces, partitioned ces and cut are printed.
+            - The subsystems of all states share one network, their repertoires and MIPs.
+            - States are checked from the TPM before calling pyphi: unreachable states 
+            (see get_reachable_states) get phi NaN, rather than pyphi raising a StateUnreachableError, 
+            and every state gets phi 0 if the network is not strongly connected (see get_connectivity), 
+            e.g. if each neuron's future only depends on its own past. 
+            - skipped: if given a list, a (state, reason) pair is appended to it for every state not passed to pyphi.
+            - If PhiCalculator.cache is set, cached phis are used and new ones are added to it
+            (verbose_state is always computed, to print its details).
+            - PhiCalculator.backend chooses how SIA is computed (verbose_state always uses pyphi).
+            - If PhiCalculator.pool is set, the states are computed in its worker processes.
+            - pyphi.config is changed for this network only, as PhiCalculator.scheduling chooses (see get_scheduled_config).
+            - States whose SIA exceeds PhiCalculator.sia_time_budget or sia_memory_budget get phi NaN, 
+            with reason "time budget exceeded" or "memory budget exceeded" in skipped (see run_with_budget), 
+            and are not added to the cache.
+        """
+        if PhiCalculator.pool is not None and states is None:
+            return PhiCalculator.pool.map_state_phis([TPM], [num_states_per_node], [verbose_state], skipped)[0]
+        with pyphi.config.override(**PhiCalculator.get_scheduled_config(num_states_per_node)):
+            return PhiCalculator._compute_state_phis(TPM, num_states_per_node, verbose_state, skipped, states)
+
+    @staticmethod
+    def _compute_state_phis(TPM, num_states_per_node, verbose_state=None, skipped=None, states=None):
+        # get_state_phis in this process, with pyphi.config as it is
+        system_states = Helpers.get_system_states(num_states_per_node)
+        if states is None:
+            states = system_states
+        cache = PhiCalculator.cache
+        if cache is not None:
+            keys = cache.get_keys(TPM, num_states_per_node, states)
+            cached = cache.get_many(keys)
+            if len(cached) == len(keys) and verbose_state not in states:
+                return [cached[key] for key in keys]
+
         network = pyphi.Network(
-        (TPM),
-        num_states_per_node=[4,4]
+        Helpers.to_dense(TPM),
+        num_states_per_node=num_states_per_node
         )
+        if getattr(pyphi.config, "VALIDATE_SUBSYSTEM_STATES", True):
+            reachable = PhiCalculator.get_reachable_states(TPM, num_states_per_node)
+            reachable = reachable[[system_states.index(state) for state in states]]
+        else:
+            reachable = np.ones(len(states), dtype=bool)
+        connectivity = PhiCalculator.get_connectivity(TPM, num_states_per_node)
+        strongly_connected = len(num_states_per_node) < 2 or pyphi.connectivity.is_strong(connectivity)
+        assert PhiCalculator.backend in ('pyphi', 'two_element')
+        engine = None
+        if PhiCalculator.backend == 'two_element':
+            reason = TwoElementSIA.get_unsupported_reason(num_states_per_node)
+            if reason is None:
+                engine = TwoElementSIA(TPM, num_states_per_node)
+            elif reason not in PhiCalculator._backend_warnings:
+                PhiCalculator._backend_warnings.add(reason)
+                warnings.warn("PhiCalculator.backend is 'two_element', but pyphi computes the phis instead: " + reason)
+        # repertoires and MIPs shared by the subsystems of all states, see StateBatchedSubsystem
+        shared = {}
         phis = []
-        states = Helpers.get_nary_states(2,4)   # not the TPM order! 
-        for state in states:
-            subsystem = pyphi.Subsystem(network, state)
-            sia = pyphi.compute.sia(subsystem)
-            if state == (0,1):
-                if verbose:
-                    print(sia.ces)
-                    print(sia.partitioned_ces)
-                    print(sia.cut)
+        computed = []
+        for i, state in enumerate(states):
+            if cache is not None and keys[i] in cached and state != verbose_state:
+                phis.append(cached[keys[i]])
+                continue
+            if not reachable[i]:
+                phis.append(np.nan)
+                if skipped is not None:
+                    skipped.append((state, "unreachable"))
+                continue
+            if not strongly_connected and state != verbose_state:
+                phis.append(0.0)
+                if skipped is not None:
+                    skipped.append((state, "not strongly connected"))
+                continue
+            try:
+                if engine is not None and state != verbose_state:
+                    phis.append(PhiCalculator.run_with_budget(engine.get_phi, state))
+                    computed.append(i)
+                    continue
+                subsystem = StateBatchedSubsystem(network, state, shared=shared)
+                sia = PhiCalculator.run_with_budget(pyphi.compute.sia, subsystem)
+            except SIABudgetExceeded as e:
+                phis.append(np.nan)
+                if skipped is not None:
+                    skipped.append((state, str(e)))
+                continue
+            if state == verbose_state:
+                print(sia.ces)
+                print(sia.partitioned_ces)
+                print(sia.cut)
             phis.append(sia.phi)
-        if verbose:
-            print(phis)
-        
+            computed.append(i)
+        if cache is not None:
+            cache.put_many({keys[i]: phis[i] for i in computed})
         return phis
-    
+
     @staticmethod
-    def get_micro_average_phi(TPM,verbose=True):
-        phis = PhiCalculator.get_micro_phis(TPM, verbose)
+    def get_status(skipped):
+        """The STATUS_FLAGS of the reasons in a skipped list from get_state_phis, combined; 0 if every state had its SIA computed"""
+        status = 0
+        for _, reason in skipped:
+            status |= PhiCalculator.STATUS_FLAGS[reason]
+        return status
+
+    @staticmethod
+    def run_with_budget(compute, *args):
+        """
+        compute(*args), cancelled with SIABudgetExceeded if it runs for longer than PhiCalculator.sia_time_budget 
+        seconds or allocates more than PhiCalculator.sia_memory_budget bytes, so that one pathological TPM 
+        cannot hold up a whole sweep. Without budgets (None), this is just compute(*args).
+            - The time budget uses SIGALRM, so it only works in the main thread of a process 
+            (as in MPI ranks and PhiPool workers), on Unix. The alarm repeats every 0.1 seconds until compute 
+            has stopped, as code that catches every exception (e.g. logging.Handler.handleError around pyphi's 
+            log calls) can swallow a single one. 
+            - The memory budget temporarily limits the address space of the process (RLIMIT_AS) to its 
+            current size plus the budget, on Linux; running out shows up as a MemoryError. 
+            - Processes started by compute (e.g. pyphi's cut workers with inner parallelism) are terminated 
+            when it is cancelled (or fails).
+        """
+        time_budget, memory_budget = PhiCalculator.sia_time_budget, PhiCalculator.sia_memory_budget
+        if time_budget is None and memory_budget is None:
+            return compute(*args)
+        import resource   # Unix only, so only imported when a budget is set
+        children = set(multiprocessing.active_children())
+        previous_handler, previous_limit = None, None
+        completed = False
+        try:
+            if time_budget is not None:
+                previous_handler = signal.signal(signal.SIGALRM, _raise_time_budget_exceeded)
+                signal.setitimer(signal.ITIMER_REAL, time_budget, 0.1)
+            if memory_budget is not None:
+                previous_limit = resource.getrlimit(resource.RLIMIT_AS)
+                with open("/proc/self/statm") as statm:
+                    address_space = int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+                limit = address_space + int(memory_budget)
+                if previous_limit[1] != resource.RLIM_INFINITY:
+                    limit = min(limit, previous_limit[1])
+                resource.setrlimit(resource.RLIMIT_AS, (limit, previous_limit[1]))
+            try:
+                result = compute(*args)
+                completed = True
+            except MemoryError:
+                if memory_budget is None:
+                    raise
+                raise SIABudgetExceeded("memory budget exceeded")
+        finally:
+            if time_budget is not None:
+                _stop_time_budget(previous_handler)
+            if not completed:
+                for child in set(multiprocessing.active_children()) - children:
+                    child.terminate()
+                    child.join()
+            if previous_limit is not None:
+                resource.setrlimit(resource.RLIMIT_AS, previous_limit)
+        return result
+
+    @staticmethod
+    def get_free_cores():
+        """
+        The number of cores free for this process: PhiCalculator.cores if set, otherwise the cores it may run on 
+        (its CPU affinity) that are not busy by the 1-minute load average (which counts this process too). 
+        The load average lags, so ranks that start together all see the cores free; set PhiCalculator.cores for them.
+        """
+        if PhiCalculator.cores is not None:
+            return PhiCalculator.cores
+        if hasattr(os, "sched_getaffinity"):
+            available = len(os.sched_getaffinity(0))
+        else:
+            available = os.cpu_count() or 1
+        busy = math.floor(os.getloadavg()[0]) - 1 if hasattr(os, "getloadavg") else 0
+        return max(1, min(available, available - busy))
+
+    @staticmethod
+    def get_parallelism(num_states_per_node):
+        """
+        Where the parallelism is for computing the phis of a network under PhiCalculator.scheduling: 
+        'inner' (pyphi's own, over the cuts of each SIA), 'outer' (over networks and states, 
+        e.g. with PhiCalculator.pool or one MPI rank per pair), or None to leave pyphi.config as it is.
+            - 'auto' chooses 'inner' for large networks, with at least inner_min_nodes nodes or inner_min_states states, 
+            where a single SIA is the bottleneck, if more than one core is free, and 'outer' otherwise. 
+            Pairs have only two cuts, so they gain little from inner parallelism.
+        """
+        scheduling = PhiCalculator.scheduling
+        assert scheduling in (None, 'auto', 'outer', 'inner')
+        if scheduling != 'auto':
+            return scheduling
+        large = (len(num_states_per_node) >= PhiCalculator.inner_min_nodes 
+                 or np.prod(num_states_per_node) >= PhiCalculator.inner_min_states)
+        return 'inner' if large and PhiCalculator.get_free_cores() > 1 else 'outer'
+
+    @staticmethod
+    def get_scheduled_config(num_states_per_node):
+        """The pyphi.config options to override while computing the phis of a network, see get_parallelism"""
+        parallelism = PhiCalculator.get_parallelism(num_states_per_node)
+        if parallelism == 'inner':
+            # not both: pyphi evaluates the concepts of each cut inside its cut workers, which cannot start processes
+            return dict(PARALLEL_CUT_EVALUATION=True, PARALLEL_CONCEPT_EVALUATION=False, 
+                        NUMBER_OF_CORES=PhiCalculator.get_free_cores())
+        if parallelism == 'outer':
+            return dict(PARALLEL_CUT_EVALUATION=False, PARALLEL_CONCEPT_EVALUATION=False)
+        return {}
+
+    @staticmethod
+    def validate_two_element_backend(TPM, num_states_per_node, verbose=True):
+        """
+        Compares the phis of TwoElementSIA with those of pyphi.compute.sia for every reachable state 
+        of a 2-element network, with the current pyphi.config. 
+        Returns whether they agree up to pyphi.config.PRECISION, and the two lists of phis.
+        """
+        assert TwoElementSIA.supports(num_states_per_node), "TwoElementSIA does not support this network or pyphi.config"
+        engine = TwoElementSIA(TPM, num_states_per_node)
+        network = pyphi.Network(Helpers.to_dense(TPM), num_states_per_node=num_states_per_node)
+        reachable = PhiCalculator.get_reachable_states(TPM, num_states_per_node)
+        two_element_phis, pyphi_phis = [], []
+        for state, is_reachable in zip(Helpers.get_system_states(num_states_per_node), reachable):
+            if not is_reachable:
+                continue
+            two_element_phis.append(engine.get_phi(state))
+            pyphi_phis.append(pyphi.compute.sia(pyphi.Subsystem(network, state)).phi)
+            if verbose and abs(two_element_phis[-1] - pyphi_phis[-1]) > 10**-pyphi.config.PRECISION:
+                print("State", state, "two_element:", two_element_phis[-1], "pyphi:", pyphi_phis[-1])
+        agree = np.allclose(two_element_phis, pyphi_phis, rtol=0, atol=10**-pyphi.config.PRECISION)
+        return agree, two_element_phis, pyphi_phis
+
+    @staticmethod
+    def get_node_marginals(TPM, num_states_per_node):
+        """
+        The marginal distribution of the next state of each node, given each current state of the system:
+        a list with an array of shape (num states, num_states_per_node[k]) for each node k. 
+        """
+        TPM = Helpers.to_dense(TPM)
+        num_nodes = len(num_states_per_node)
+        # TPM columns as an array with an axis per node, node 0 being the last (fastest varying) axis
+        TPM = TPM.reshape((TPM.shape[0],) + tuple(num_states_per_node[::-1]))
+        marginals = []
+        for k in range(num_nodes):
+            other_axes = tuple(1 + num_nodes - 1 - j for j in range(num_nodes) if j != k)
+            marginals.append(TPM.sum(axis=other_axes))
+        return marginals
+
+    @staticmethod
+    def get_reachable_states(TPM, num_states_per_node):
+        """
+        Whether each state (in the order of Helpers.get_system_states) can be reached from some state,
+        as pyphi checks it: for some current state, the marginal of every node's value in the state is non-zero.
+        """
+        marginals = PhiCalculator.get_node_marginals(TPM, num_states_per_node)
+        states = np.array(Helpers.get_system_states(num_states_per_node)).reshape(-1, len(num_states_per_node))
+        reachable = np.ones((marginals[0].shape[0], len(states)), dtype=bool)
+        for k in range(len(num_states_per_node)):
+            reachable &= marginals[k][:, states[:, k]] > 0
+        return reachable.any(axis=0)
+
+    @staticmethod
+    def get_connectivity(TPM, num_states_per_node, tol=1e-12):
+        """
+        The connectivity matrix implied by the TPM: cm[j,k] is 1 if the next state of node k depends on 
+        the current state of node j, i.e. if the marginals of node k vary by more than tol with it 
+        (tol only absorbs the rounding errors of summing the TPM columns). 
+        If the TPM is the product of each node's marginals given only its own past, 
+        cm is diagonal and the network is reducible.
+        """
+        num_nodes = len(num_states_per_node)
+        cm = np.zeros((num_nodes, num_nodes), dtype=int)
+        for k, marginal in enumerate(PhiCalculator.get_node_marginals(TPM, num_states_per_node)):
+            # current states with an axis per node, node 0 being the last axis
+            marginal = marginal.reshape(tuple(num_states_per_node[::-1]) + (num_states_per_node[k],))
+            for j in range(num_nodes):
+                cm[j, k] = np.ptp(marginal, axis=num_nodes - 1 - j).max() > tol
+        return cm
+
+    @staticmethod
+    def get_deduplicated_state_phis(TPMs, num_states_l, known=None, verbose_states=None, skipped=None):
+        """
+        Gets the state phis (as get_state_phis) of each TPM, computing SIA only once for TPMs 
+        that are equal up to a permutation of their elements (see CoarseGrainer.get_canonical_form). 
+            - known: (TPM, num_states_per_node, state_phis) triples whose phis are already computed, 
+            e.g. those of the micro TPM from get_micro_phis. 
+            - verbose_states: the verbose_state for each TPM; only printed for the first TPM of each class.
+            - skipped: see get_state_phis; the skipped states of each class are only appended once, 
+            as states of its canonical TPM.
+        The new classes are computed together, so they are spread over PhiCalculator.pool if it is set.
+        """
+        # phis of the states of each class, by state of the canonical TPM
+        class_phis = {}
+        for TPM, num_states, state_phis in (known or []):
+            key, _, _, permutation = CoarseGrainer.get_canonical_form(TPM, num_states)
+            states = Helpers.get_system_states(num_states)
+            class_phis[key] = {tuple(state[p] for p in permutation): phi for state, phi in zip(states, state_phis)}
+
+        canonical_forms = [CoarseGrainer.get_canonical_form(TPMs[i], num_states_l[i]) for i in range(len(TPMs))]
+        # the first TPM of each class without phis yet
+        new = {}
+        for i, (key, _, _, _) in enumerate(canonical_forms):
+            if key not in class_phis and key not in new:
+                new[key] = i
+        new_TPMs, new_num_states, new_verbose_states = [], [], []
+        for key, i in new.items():
+            _, canonical_TPM, canonical_num_states, permutation = canonical_forms[i]
+            verbose_state = None if verbose_states is None else verbose_states[i]
+            if verbose_state is not None:
+                verbose_state = tuple(verbose_state[p] for p in permutation)
+            new_TPMs.append(canonical_TPM)
+            new_num_states.append(canonical_num_states)
+            new_verbose_states.append(verbose_state)
+        if PhiCalculator.pool is not None:
+            new_phis = PhiCalculator.pool.map_state_phis(new_TPMs, new_num_states, new_verbose_states, skipped)
+        else:
+            new_phis = [PhiCalculator.get_state_phis(*args, skipped=skipped) for args in zip(new_TPMs, new_num_states, new_verbose_states)]
+        for key, canonical_num_states, canonical_phis in zip(new, new_num_states, new_phis):
+            class_phis[key] = dict(zip(Helpers.get_system_states(canonical_num_states), canonical_phis))
+
+        phis = []
+        for i in range(len(TPMs)):
+            key, _, _, permutation = canonical_forms[i]
+            states = Helpers.get_system_states(num_states_l[i])
+            phis.append([class_phis[key][tuple(state[p] for p in permutation)] for state in states])
+        return phis
+
+    @staticmethod
+    def get_micro_average_phi(TPM,verbose=True, num_states_per_node=None):
+        phis = PhiCalculator.get_micro_phis(TPM, verbose, num_states_per_node)
         return sum(phis) / len(phis)
 
     @staticmethod
@@ -365,24 +2004,9 @@ class PhiCalculator:
             num_states_per_elem = [2,2]
         
         macro_TPM = CoarseGrainer.coarse_grain_nonbinary_TPM(micro_TPM, state_map, num_states_per_elem)
-        network = pyphi.Network(
-        macro_TPM,
-        num_states_per_node=num_states_per_elem
-        )
-
-        states = Helpers.get_system_states(num_states_per_elem)
-        phis = []
-        for state in states:
-            subsystem = pyphi.Subsystem(network, state)
-            sia = pyphi.compute.sia(subsystem)
-            phis.append(sia.phi)
-        
-        if verbose:
-            print(sia.ces)
-            print(sia.partitioned_ces)
-            print(sia.cut)
-        
-        return phis
+        # when verbose, print the details of the last state
+        last_state = tuple(n - 1 for n in num_states_per_elem)
+        return PhiCalculator.get_state_phis(macro_TPM, num_states_per_elem, verbose_state=last_state if verbose else None)
 
     @staticmethod
     def get_macro_average_phi(micro_TPM, verbose=True, state_map=None, num_states_per_elem=None):
@@ -397,6 +2021,11 @@ class PhiCalculator:
             state_map = {0: [0,1,2, 4,5,6, 8,9,10], 1: [3,7,11], 2: [12,13,14], 3:[15]} 
             num_states_per_elem = [2,2]
 
+        return PhiCalculator.get_weighted_macro_average(phis, occurrences, state_map)
+
+    @staticmethod
+    def get_weighted_macro_average(phis, occurrences, state_map):
+        """Weights macro state phis by how often their micro states occur"""
         macro_occurrences = [sum([occurrences[i] for i in state_map[key]]) for key in state_map]
         total_occurrences = sum(macro_occurrences)
         weights = [m / total_occurrences for m in macro_occurrences]
@@ -405,11 +2034,20 @@ class PhiCalculator:
         return sum(weighted_phis) / len(weighted_phis)
 
     @staticmethod
-    def all_coarsegrains_get_macro_average_phi(micro_TPM, verbose=True):
-        
+    def all_coarsegrains_get_macro_average_phi(micro_TPM, verbose=True, micro_phis=None, skipped=None):
+        """
+            - micro_phis: the state phis of micro_TPM from get_micro_phis, if already computed, 
+            so that the finest coarse-graining (the micro TPM itself) needs no SIA.
+            - skipped: see get_deduplicated_state_phis.
+        Macro TPMs equal up to swapping the elements are only evaluated once.
+        """
         # ways to coarse grain each element
         element_coarse_grainings = [[[0], [1,2,3]], [[0,1,2],[3]], [[0], [1,2], [3]], [[0], [1], [2], [3]]]
         states, num_states_l = CoarseGrainer.get_state_maps(element_coarse_grainings)
+        macro_TPMs = CoarseGrainer.coarse_grain_nonbinary_TPMs(micro_TPM, states, num_states_l)
+        known = None if micro_phis is None else [(micro_TPM, [4,4], micro_phis)]
+        verbose_states = [tuple(n - 1 for n in num_states) for num_states in num_states_l] if verbose else None
+        all_state_phis = PhiCalculator.get_deduplicated_state_phis(macro_TPMs, num_states_l, known, verbose_states, skipped)
             
         phis = []
         for i in range(len(states)):
@@ -417,16 +2055,21 @@ class PhiCalculator:
             if verbose:
                 print(state_map, num_states)
                 print("\n")
-            average_phi = PhiCalculator.get_macro_average_phi(micro_TPM, verbose=verbose, state_map=state_map, num_states_per_elem=num_states)
-            phis.append(average_phi)
+            state_phis = all_state_phis[i]
+            phis.append(sum(state_phis) / len(state_phis))
         
         return phis
     
     @staticmethod
-    def all_coarsegrains_get_macro_weighted_average_phi(micro_TPM, occurrences, verbose=True):
+    def all_coarsegrains_get_macro_weighted_average_phi(micro_TPM, occurrences, verbose=True, micro_phis=None, skipped=None):
+        """See all_coarsegrains_get_macro_average_phi"""
         # ways to coarse grain each element
         element_coarse_grainings = [[[0], [1,2,3]], [[0,1,2],[3]], [[0], [1,2], [3]], [[0], [1], [2], [3]]]
         states, num_states_l = CoarseGrainer.get_state_maps(element_coarse_grainings)
+        macro_TPMs = CoarseGrainer.coarse_grain_nonbinary_TPMs(micro_TPM, states, num_states_l)
+        known = None if micro_phis is None else [(micro_TPM, [4,4], micro_phis)]
+        verbose_states = [tuple(n - 1 for n in num_states) for num_states in num_states_l] if verbose else None
+        all_state_phis = PhiCalculator.get_deduplicated_state_phis(macro_TPMs, num_states_l, known, verbose_states, skipped)
             
         phis = []
         for i in range(len(states)):
@@ -434,13 +2077,97 @@ class PhiCalculator:
             if verbose:
                 print(state_map, num_states)
                 print("\n")
-            average_phi = PhiCalculator.get_macro_weighted_average_phi(micro_TPM, occurrences, verbose=verbose, state_map=state_map, num_states_per_elem=num_states)
+            state_phis = all_state_phis[i]
+            average_phi = PhiCalculator.get_weighted_macro_average(state_phis, occurrences, state_map)
             phis.append(average_phi)
         return phis
 
+    @staticmethod
+    def search_coarse_graining(micro_TPM, num_states_per_elem=None, occurrences=None, budget=50, beam_width=1, order_preserving=False, verbose=False):
+        """
+        Searches for the coarse-graining with the highest average phi, without evaluating all of them. 
+        Starting from the micro system, it repeatedly merges two macro states of one element, 
+        keeping the beam_width best coarse-grainings at each step (beam_width=1 is a greedy search), 
+        until every element has 2 macro states or budget phi evaluations (one per coarse-graining) have been used.
+            - occurrences: if given, phis are weighted by state occurrences (see get_weighted_macro_average), 
+            otherwise the plain average is used. 
+            - order_preserving: only merge adjacent blocks of contiguous states. 
+            - States with phi NaN (unreachable, or over the SIA budget) are left out of a coarse-graining's phi: 
+            the average is over the other states, and when weighting, their micro states get weight 0. 
+            A coarse-graining whose states all have phi NaN has phi NaN, and ranks below every other one.
+        A coarse-graining reached by different merge orders is only evaluated once. 
+        Returns the best coarse-graining found (see CoarseGrainer.get_state_map), its phi, and the number of evaluations.
+        """
+        if num_states_per_elem is None:
+            num_states_per_elem = [4,4]
+        assert budget >= 1 and beam_width >= 1
+        evaluated = {}
+
+        def evaluate(coarse_grain, macro_TPM):
+            num_states = [len(elem) for elem in coarse_grain]
+            grouping = [[list(block) for block in elem] for elem in coarse_grain]
+            state_phis = np.array(PhiCalculator.get_state_phis(macro_TPM, num_states), dtype=np.float64)
+            has_phi = ~np.isnan(state_phis)
+            if not has_phi.any():
+                phi = np.nan
+            elif occurrences is None:
+                phi = state_phis[has_phi].mean()
+            else:
+                state_map = CoarseGrainer.get_state_map(grouping)
+                weighted_occurrences = np.array(occurrences, dtype=np.float64)
+                for i, key in enumerate(state_map):
+                    if not has_phi[i]:
+                        weighted_occurrences[state_map[key]] = 0
+                phi = PhiCalculator.get_weighted_macro_average(np.where(has_phi, state_phis, 0), weighted_occurrences, state_map)
+            if verbose:
+                print(grouping, phi)
+            evaluated[tuple(coarse_grain)] = phi
+            return phi
+
+        def rank(phi):
+            return -np.inf if np.isnan(phi) else phi
+
+        finest = [tuple((state,) for state in range(n)) for n in num_states_per_elem]
+        micro_TPM = Helpers.to_dense(micro_TPM)
+        beam = [(evaluate(finest, micro_TPM), finest, micro_TPM)]
+        best_phi, best_grain = beam[0][0], finest
+
+        while beam and len(evaluated) < budget:
+            candidates = []
+            for _, coarse_grain, macro_TPM in beam:
+                for n, elem in enumerate(coarse_grain):
+                    if len(elem) <= 2:   # a coarser element has no states to distinguish
+                        continue
+                    for a, b in itertools.combinations(range(len(elem)), 2):
+                        if order_preserving and b != a + 1:
+                            continue
+                        merged = tuple(sorted(elem[a] + elem[b]))
+                        child_elem = elem[:a] + (merged,) + elem[a+1:b] + elem[b+1:]
+                        child_grain = coarse_grain[:n] + [child_elem] + coarse_grain[n+1:]
+                        if tuple(child_grain) in evaluated or len(evaluated) >= budget:
+                            continue
+                        labels = [j if j < b else (a if j == b else j - 1) for j in range(len(elem))]
+                        child_TPM = CoarseGrainer._merge_macro_TPM(macro_TPM, coarse_grain, n, labels)
+                        candidates.append((evaluate(child_grain, child_TPM), child_grain, child_TPM))
+            candidates.sort(key=lambda candidate: -rank(candidate[0]))
+            beam = candidates[:beam_width]
+            if beam and rank(beam[0][0]) > rank(best_phi):
+                best_phi, best_grain = beam[0][0], beam[0][1]
+
+        best_grain = [[list(block) for block in elem] for elem in best_grain]
+        return best_grain, best_phi, len(evaluated)
+
+
 
 class Helpers:
 
+    @staticmethod
+    def to_dense(TPM):
+        """PyPhi needs dense TPMs, so convert sparse TPMs (see TPMMaker.get_TPM_nonbinary) when handing them over"""
+        if scipy.sparse.issparse(TPM):
+            return TPM.toarray()
+        return np.asarray(TPM)
+
     @staticmethod
     def get_bin_states(l):
         states = []
@@ -536,12 +2263,20 @@ class DataGenerator:
                     data[j, i+k] = binary_state[k]
         return data
 
-def get_phis(r, t, num_transitions, infolder, outfolder):
+def get_phis(r, t, num_transitions, infolder, outfolder, cache=None):
+    """
+    - cache is an optional RasterCache; if given, the binarised trains of the pair
+    are taken from the cached rasters of the whole probe instead of from the spike files.
+    - Next to the micro and macro phis, the status of each (binsize, skip) is saved as micro_status and 
+    macro_status: the PhiCalculator.STATUS_FLAGS of why phis are NaN or were not computed by SIA 
+    (infeasible, unreachable states, SIA budgets exceeded, ...), 0 if every state was computed.
+    """
     ### LOAD DATASET ###
     print("get_phis")
-    i_sec = np.loadtxt(infolder + "/cell" + str(r) + ".txt") / 1000   # divide through as they are loaded in miliseconds
-    j_sec = np.loadtxt(infolder + "/cell" + str(t) + ".txt") / 1000
-    cluster = np.array([i_sec, j_sec])
+    if cache is None:
+        i_sec = np.loadtxt(infolder + "/cell" + str(r) + ".txt") / 1000   # divide through as they are loaded in miliseconds
+        j_sec = np.loadtxt(infolder + "/cell" + str(t) + ".txt") / 1000
+        cluster = [i_sec, j_sec]
     print("after load dataset")
     ### COMPUTE PHIS ###
     NUM_COARSE_GRAININGS = 16
@@ -555,36 +2290,56 @@ def get_phis(r, t, num_transitions, infolder, outfolder):
 
 
     micro_phis = np.zeros((len(binsizes), len(skips)))
-    macro_phis = [np.zeros((len(binsizes), len(skips),NUM_COARSE_GRAININGS))]
+    macro_phis = np.zeros((len(binsizes), len(skips),NUM_COARSE_GRAININGS))
+    micro_status = np.zeros((len(binsizes), len(skips)), dtype=np.int64)
+    macro_status = np.zeros((len(binsizes), len(skips)), dtype=np.int64)
+
+    # binarise once for every binsize, rather than once per (binsize, skip)
+    if cache is None:
+        binarised = Neuron.binarise_spiketrains(cluster, binsizes)
+    else:
+        binarised = [raster.neurons([r, t]) for raster in cache.get_many(infolder, binsizes)]
+
+    # only build TPMs and compute phis for the configs where every state is observed often enough
+    feasible = TPMMaker.get_feasibility(binarised, [NUM_BITS], skips, num_transitions)[:,0,:]
 
     for i in range(len(binsizes)):
         binsize = binsizes[i]
+        # the TPMs of every feasible skip, from a single encoding of the binarised trains
+        feasible_skips = [skips[j] for j in range(len(skips)) if feasible[i,j]]
+        if feasible_skips:
+            TPMs,_ = TPMMaker.get_TPMs_nonbinary(binarised[i],NUM_BITS,feasible_skips,num_transitions)
         for j in range(len(skips)):
             skip = skips[j]
 
-            try:
-                TPM,_ = TPMMaker.TPM_from_spiketrains(cluster,binsize,NUM_BITS,skip,num_transitions)
+            success = feasible[i,j]
+            if success:
+                TPM = TPMs[feasible_skips.index(skip)]
                 tpmname = "micro_" + str(i) + "_" + str(j) + "_occs_" + str(num_transitions) + "_bin_"+str(binsize)+"_skip_"+str(skip)+".csv" 
                 np.savetxt(outfolder+"/"+tpmname, TPM)
-                success = True
-            except:
-                success = False
-            
-            if success:
-                micro_phis[i,j] = PhiCalculator.get_micro_average_phi(TPM, verbose=False)
-                all_coarse_macros = PhiCalculator.all_coarsegrains_get_macro_average_phi(TPM, verbose=False)
+
+                micro_skipped, macro_skipped = [], []
+                state_phis = PhiCalculator.get_micro_phis(TPM, verbose=False, skipped=micro_skipped)
+                micro_phis[i,j] = sum(state_phis) / len(state_phis)
+                all_coarse_macros = PhiCalculator.all_coarsegrains_get_macro_average_phi(TPM, verbose=False, micro_phis=state_phis, skipped=macro_skipped)
                 macro_phis[i,j] = all_coarse_macros
+                micro_status[i,j] = PhiCalculator.get_status(micro_skipped)
+                # the finest coarse-graining is the micro system itself
+                macro_status[i,j] = PhiCalculator.get_status(micro_skipped + macro_skipped)
                 #macro_phis[i,j] = np.nanmax(all_coarse_macros)
             
             else:
                 micro_phis[i,j] = None
                 macro_phis[i,j] = [None for i in range(NUM_COARSE_GRAININGS)]
+                micro_status[i,j] = macro_status[i,j] = PhiCalculator.STATUS_FLAGS["infeasible"]
     
     micro_phis = np.array(micro_phis, dtype=np.float64)
     macro_phis = np.array(macro_phis, dtype=np.float64)
 
     np.save(outfolder + "/micro_" + str(r) + "_" + str(t), micro_phis)
     np.save(outfolder + "/macro_" + str(r) + "_" + str(t), macro_phis)
+    np.save(outfolder + "/micro_status_" + str(r) + "_" + str(t), micro_status)
+    np.save(outfolder + "/macro_status_" + str(r) + "_" + str(t), macro_status)
     #max_micro = np.nanmax(micro_phis)
     #max_macro = np.nanmax(macro_phis)
     #macro_win = True if max_macro > max_micro else False
@@ -0,0 +1,280 @@
+import inspect
+import logging
+import os
+import signal
+import time
+import warnings
+
+import numpy as np
+import pytest
+
+import pyphi
+
+from temporal_emergence import TPMMaker, OnlineTPMEstimator, PhiCalculator, PhiPool, Raster, RasterCache, SIABudgetExceeded, TwoElementSIA, get_phis
+
+# the nonbinary fork of pyphi, whose networks take num_states_per_node
+requires_nonbinary = pytest.mark.skipif("num_states_per_node" not in inspect.signature(pyphi.Network).parameters, 
+                                        reason="needs the nonbinary fork of pyphi")
+# the pyphi.config of the drivers
+DRIVER_CONFIG = dict(PARTITION_TYPE='ALL', MEASURE='AID', USE_SMALL_PHI_DIFFERENCE_FOR_CES_DISTANCE=True, 
+                     ASSUME_CUTS_CANNOT_CREATE_NEW_CONCEPTS=True, PARALLEL_CUT_EVALUATION=False, 
+                     PARALLEL_CONCEPT_EVALUATION=False)
+
+
+def get_batch_transitions(spiketrains, S, K, skipby, until):
+    """The transitions of the whole recording up to until, counted from a single encoding"""
+    num_bins = int(until / S)
+    binarised = np.zeros((len(spiketrains), num_bins))
+    for n, train in enumerate(spiketrains):
+        indices = (np.asarray(train) / S).astype(np.int64)
+        binarised[n, indices[indices < num_bins]] = 1
+    codes = TPMMaker.encode_states(binarised, K).astype(np.int64)
+    size = (2**K)**len(spiketrains)
+    return TPMMaker.count_transitions(codes[:-skipby], codes[skipby:], size)
+
+
+@pytest.mark.parametrize("step", [0.015, 0.02, 0.05, 0.1, 1.0])
+def test_online_estimator_matches_batch_counts(step):
+    rng = np.random.default_rng(0)
+    duration, S, K, skipby = 20.0, 0.01, 2, 4
+    spiketrains = [np.sort(rng.uniform(0, duration, 600)) for _ in range(2)]
+    expected = get_batch_transitions(spiketrains, S, K, skipby, duration)
+
+    estimator = OnlineTPMEstimator(len(spiketrains), S, K, skipby)
+    for start in np.arange(0, duration, step):
+        until = min(start + step, duration)
+        new = [train[(train >= start) & (train < until)] for train in spiketrains]
+        estimator.update(new, until)
+
+    assert estimator.num_transitions.sum() == expected.sum()
+    assert np.array_equal(estimator.num_transitions, expected)
+
+
+def test_raster_cache_loads_spike_files_once(tmp_path, monkeypatch):
+    rng = np.random.default_rng(2)
+    infolder = tmp_path / "session"
+    infolder.mkdir()
+    for cell in range(3):
+        np.savetxt(infolder / "cell{}.txt".format(cell), np.sort(rng.uniform(0, 10000, 500)))   # in ms
+    spiketrains = [np.loadtxt(infolder / "cell{}.txt".format(cell)) / 1000 for cell in range(3)]
+    loadtxt = np.loadtxt
+    loaded = []
+    def counting_loadtxt(*args, **kwargs):
+        loaded.append(args[0])
+        return loadtxt(*args, **kwargs)
+    monkeypatch.setattr(np, "loadtxt", counting_loadtxt)
+
+    binsizes = [0.003, 0.01, 0.02]
+    cache = RasterCache(str(tmp_path / "cache"))
+    rasters = cache.get_many(str(infolder), binsizes)
+    assert len(loaded) == 3
+    for raster, S in zip(rasters, binsizes):
+        assert np.array_equal(raster.to_dense(), Raster.from_spiketrains(spiketrains, S).to_dense())
+
+    # cached: nothing is parsed again, and only the missing binsize is built
+    assert np.array_equal(cache.get(str(infolder), 0.01).to_dense(), rasters[1].to_dense())
+    assert len(loaded) == 3
+    cache.get_many(str(infolder), binsizes + [0.005])
+    assert len(loaded) == 6
+
+
+def test_get_TPMs_nonbinary_budgets_the_whole_stack(monkeypatch):
+    rng = np.random.default_rng(3)
+    binarised = (rng.random((2, 5000)) < 0.3).astype(np.float64)
+    skips = [2, 4, 6]
+    # one 16x16 TPM and its counts fit in the budget, but not those of all three skips
+    monkeypatch.setattr(TPMMaker, "DENSE_MEMORY_BUDGET", 2 * 16 * 16 * 8 + 1)
+    assert not TPMMaker.use_sparse(16)
+
+    np.random.seed(0)
+    TPMs, num_transitions = TPMMaker.get_TPMs_nonbinary(binarised, 2, skips, 10)
+    assert isinstance(TPMs, list)
+    np.random.seed(0)
+    dense_TPMs, _ = TPMMaker.get_TPMs_nonbinary(binarised, 2, skips, 10, sparse=False)
+    for TPM, dense_TPM in zip(TPMs, dense_TPMs):
+        assert np.allclose(TPM.toarray(), dense_TPM)
+
+
+def test_get_TPM_ensemble_samples_required_obs_per_state():
+    rng = np.random.default_rng(4)
+    binarised = (rng.random((2, 20000)) < 0.3).astype(np.float64)
+    np.random.seed(0)
+    TPMs, _ = TPMMaker.get_TPM_ensemble(binarised, 2, 2, 100, max_replicates=300, tol=0)
+    assert len(TPMs) == 300
+    # every replicate is a different sample, and they average to the TPM of all the observations
+    assert not np.allclose(TPMs[0], TPMs[1])
+    codes = TPMMaker.encode_states(binarised, 2).astype(np.int64)
+    full = TPMMaker.count_transitions(codes[:-2], codes[2:], 16)
+    full /= full.sum(axis=1, keepdims=True)
+    assert np.abs(TPMs.mean(axis=0) - full).max() < 0.02
+
+
+def stub_state_phis(micro_phis, macro_phi):
+    """get_state_phis giving micro_phis for the 4x4 micro system and macro_phi for every state of coarser ones"""
+    def get_state_phis(TPM, num_states_per_node, *args, **kwargs):
+        if list(num_states_per_node) == [4, 4]:
+            return list(micro_phis)
+        return [macro_phi] * int(np.prod(num_states_per_node))
+    return get_state_phis
+
+
+def test_search_coarse_graining_ranks_nan_groupings_last(monkeypatch):
+    monkeypatch.setattr(PhiCalculator, "get_state_phis", stub_state_phis([np.nan] * 16, 1.0))
+    TPM = np.full((16, 16), 1 / 16)
+    grouping, phi, _ = PhiCalculator.search_coarse_graining(TPM, budget=30)
+    assert phi == 1.0
+    assert grouping != [[[0], [1], [2], [3]], [[0], [1], [2], [3]]]
+
+
+def test_search_coarse_graining_leaves_out_nan_states(monkeypatch):
+    monkeypatch.setattr(PhiCalculator, "get_state_phis", stub_state_phis([np.nan] + [2.0] * 15, 1.0))
+    TPM = np.full((16, 16), 1 / 16)
+    grouping, phi, _ = PhiCalculator.search_coarse_graining(TPM, budget=30)
+    assert phi == 2.0
+    assert grouping == [[[0], [1], [2], [3]], [[0], [1], [2], [3]]]
+
+    occurrences = np.ones(16)
+    grouping, phi, _ = PhiCalculator.search_coarse_graining(TPM, occurrences=occurrences, budget=30)
+    assert not np.isnan(phi)
+
+
+@requires_nonbinary
+def test_get_phis_saves_budget_exceeded_status(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    for cell in [0, 1]:
+        np.savetxt(tmp_path / "cell{}.txt".format(cell), np.sort(rng.uniform(0, 60000, 12000)))   # in ms
+    def sia_out_of_memory(subsystem):
+        # as numpy fails when RLIMIT_AS is reached
+        raise MemoryError
+    monkeypatch.setattr(pyphi.compute, "sia", sia_out_of_memory)
+    monkeypatch.setattr(PhiCalculator, "sia_memory_budget", 10**9)
+
+    micro_phis, macro_phis, _ = get_phis(0, 1, 5, str(tmp_path), str(tmp_path))
+    micro_status = np.load(tmp_path / "micro_status_0_1.npy")
+    macro_status = np.load(tmp_path / "macro_status_0_1.npy")
+
+    infeasible = PhiCalculator.STATUS_FLAGS["infeasible"]
+    out_of_memory = PhiCalculator.STATUS_FLAGS["memory budget exceeded"]
+    feasible = micro_status & infeasible == 0
+    assert feasible.any()
+    assert np.all(micro_status[feasible] & out_of_memory)
+    assert np.all(macro_status[feasible] & out_of_memory)
+    assert np.all(np.isnan(micro_phis[feasible]))
+    assert np.all(np.isnan(micro_phis[~feasible]))
+    assert np.all(micro_status[~feasible] == infeasible)
+
+
+def random_TPM(rng, num_states, sparsity=0.0):
+    TPM = rng.random((num_states, num_states)) * (rng.random((num_states, num_states)) >= sparsity)
+    TPM[:, 0] += 1e-3   # every row can be normalised
+    return TPM / TPM.sum(axis=1, keepdims=True)
+
+
+@requires_nonbinary
+@pytest.mark.parametrize("measure, partition_type", [("AID", "ALL"), ("AID", "BI"), ("L1", "ALL")])
+def test_two_element_backend_matches_pyphi_on_nonbinary_pairs(measure, partition_type):
+    rng = np.random.default_rng(5)
+    config = dict(DRIVER_CONFIG, MEASURE=measure, PARTITION_TYPE=partition_type)
+    with pyphi.config.override(**config):
+        for TPM in [random_TPM(rng, 16), random_TPM(rng, 16, sparsity=0.5)]:
+            agree, two_element_phis, pyphi_phis = PhiCalculator.validate_two_element_backend(TPM, [4, 4], verbose=False)
+            assert agree, (two_element_phis, pyphi_phis)
+
+
+@requires_nonbinary
+def test_two_element_backend_warns_once_when_unsupported(monkeypatch):
+    monkeypatch.setattr(PhiCalculator, "backend", "two_element")
+    monkeypatch.setattr(PhiCalculator, "_backend_warnings", set())
+    TPM = random_TPM(np.random.default_rng(6), 4)
+    with pyphi.config.override(**dict(DRIVER_CONFIG, USE_SMALL_PHI_DIFFERENCE_FOR_CES_DISTANCE=False, MEASURE='EMD')):
+        assert not TwoElementSIA.supports([2, 2])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            PhiCalculator.get_state_phis(TPM, [2, 2])
+            PhiCalculator.get_state_phis(TPM, [2, 2])
+    assert len(caught) == 1
+    assert "USE_SMALL_PHI_DIFFERENCE_FOR_CES_DISTANCE" in str(caught[0].message)
+
+
+@requires_nonbinary
+def test_pool_matches_serial_state_phis():
+    rng = np.random.default_rng(7)
+    TPMs = [random_TPM(rng, 16), random_TPM(rng, 16, sparsity=0.5), random_TPM(rng, 4)]
+    num_states_l = [[4, 4], [4, 4], [2, 2]]
+    # pyphi's default parallelism stays on, as it is when the drivers' config is not used
+    config = dict(DRIVER_CONFIG, PARALLEL_CUT_EVALUATION=True)
+    with pyphi.config.override(**config):
+        serial_skipped = []
+        serial = [PhiCalculator.get_state_phis(TPM, num_states, skipped=serial_skipped) for TPM, num_states in zip(TPMs, num_states_l)]
+        with PhiPool(processes=2, states_per_task=5) as pool:
+            pooled_skipped = []
+            pooled = pool.map_state_phis(TPMs, num_states_l, skipped=pooled_skipped)
+    assert len(pooled) == len(serial)
+    for pooled_phis, serial_phis in zip(pooled, serial):
+        assert np.array_equal(pooled_phis, serial_phis, equal_nan=True)
+    assert pooled_skipped == serial_skipped
+
+
+def test_free_cores_leave_out_busy_cores(monkeypatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    monkeypatch.setattr(os, "getloadavg", lambda: (6.5, 6.0, 6.0), raising=False)
+    # 6 busy cores, one of them this process
+    assert PhiCalculator.get_free_cores() == 3
+    monkeypatch.setattr(os, "getloadavg", lambda: (20.0, 20.0, 20.0), raising=False)
+    assert PhiCalculator.get_free_cores() == 1
+    monkeypatch.setattr(PhiCalculator, "scheduling", "auto")
+    assert PhiCalculator.get_parallelism([2, 2, 2]) == 'outer'
+
+    monkeypatch.setattr(PhiCalculator, "cores", 4)
+    assert PhiCalculator.get_free_cores() == 4
+    assert PhiCalculator.get_parallelism([2, 2, 2]) == 'inner'
+    assert PhiCalculator.get_scheduled_config([2, 2, 2])["NUMBER_OF_CORES"] == 4
+
+
+class SlowStream:
+    """A log stream that blocks while writing, so that an alarm goes off inside a logging call"""
+    def write(self, message):
+        time.sleep(0.2)
+
+    def flush(self):
+        pass
+
+
+slow_logger = logging.getLogger("test_temporal_emergence.slow_sia")
+slow_logger.propagate = False
+slow_logger.addHandler(logging.StreamHandler(SlowStream()))
+slow_logger.setLevel(logging.INFO)
+
+
+def slow_sia_with_logging(*args):
+    # logging.Handler.handleError swallows the first alarm, as it does inside pyphi's log calls
+    slow_logger.info("computing SIA")
+    time.sleep(5)
+    return 1.0
+
+
+def test_time_budget_cancels_an_sia_that_swallows_the_first_alarm(monkeypatch):
+    monkeypatch.setattr(logging, "raiseExceptions", False)
+    monkeypatch.setattr(PhiCalculator, "sia_time_budget", 0.05)
+    previous_handler = signal.getsignal(signal.SIGALRM)
+    start = time.time()
+    with pytest.raises(SIABudgetExceeded, match="time budget exceeded"):
+        PhiCalculator.run_with_budget(slow_sia_with_logging)
+    assert time.time() - start < 1
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+    assert signal.getsignal(signal.SIGALRM) == previous_handler
+
+
+@requires_nonbinary
+def test_get_state_phis_records_time_budget_exceeded(monkeypatch):
+    monkeypatch.setattr(logging, "raiseExceptions", False)
+    monkeypatch.setattr(pyphi.compute, "sia", slow_sia_with_logging)
+    monkeypatch.setattr(PhiCalculator, "sia_time_budget", 0.05)
+    TPM = random_TPM(np.random.default_rng(8), 4)
+    skipped = []
+    start = time.time()
+    with pyphi.config.override(**DRIVER_CONFIG):
+        phis = PhiCalculator.get_state_phis(TPM, [2, 2], skipped=skipped)
+    assert time.time() - start < 4
+    assert np.all(np.isnan(phis))
+    assert [reason for _, reason in skipped] == ["time budget exceeded"] * 4